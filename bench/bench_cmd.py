@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+"""Benchmarks of ml.cmd commands.
+
+    Everything runs offline and without X: fake gvim, vim, xdg-open, smplayer, feh, ... are put on PATH,
+    HOME and XDG directories point to a temporary directory and all the data (archives, history files,
+    image trees) is generated there.
+
+    Usage:
+        bench_cmd.py [--sizes=<sizes>] [--only=<names>] [--repeat=<n>] [--save] [--baselines=<file>]
+        bench_cmd.py (-h | --help)
+
+    Options:
+        -h, --help            Print the help page
+        --sizes=<sizes>       Comma separated data sizes: small, medium, large [default: small,medium]
+        --only=<names>        Comma separated benchmark name prefixes to run (like: decomp,hist)
+        --repeat=<n>          How many times to repeat every measurement [default: 5]
+        --save                Store results as new baselines
+        --baselines=<file>    Baselines file [default: bench/baselines.json]
+
+    Every benchmark reports median time per call (and throughput where it makes sense) and compares it
+    with stored baselines; results slower than REGRESSION_FACTOR times the baseline are reported
+    as regressions (and the exit status is 1).
+
+    Baselines depend on the machine, so no baselines file is shipped: run with --save first
+    (on the code you want to compare against) to create it.
+"""
+
+import sys
+import os
+import time
+import json
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import subprocess
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from ml import cmd
+
+REGRESSION_FACTOR = 1.5
+
+SIZES = {
+    # archive members, history lines, images
+    "small": {"members": 100, "history": 1000, "images": 1000},
+    "medium": {"members": 2000, "history": 100000, "images": 20000},
+    "large": {"members": 20000, "history": 1000000, "images": 100000},
+}
+
+FAKE_BINARIES = ["gvim", "gvimdiff", "vim", "xdg-open", "smplayer", "audacious", "mpv", "feh", "x-terminal-emulator", "fakeapp"]
+
+def setup(tmpdir):
+    """Prepare fake environment (binaries, HOME, XDG directories) in given directory."""
+    bindir = os.path.join(tmpdir, "bin")
+    os.makedirs(bindir)
+    for name in FAKE_BINARIES:
+        path = os.path.join(bindir, name)
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\nexit 0\n")
+        os.chmod(path, 0o755)
+    home = os.path.join(tmpdir, "home")
+    appdir = os.path.join(home, ".local", "share", "applications")
+    os.makedirs(appdir)
+    with open(os.path.join(appdir, "fakeapp.desktop"), "w") as f:
+        f.write("[Desktop Entry]\nType=Application\nName=Fake\nExec=fakeapp %U\nMimeType=text/plain;x-scheme-handler/https;\n")
+    rundir = os.path.join(tmpdir, "run")
+    os.makedirs(rundir, 0o700)
+    os.environ.update({
+        "PATH": bindir + os.pathsep + os.environ.get("PATH", ""),
+        "HOME": home,
+        "XDG_RUNTIME_DIR": rundir,
+        "XDG_CACHE_HOME": os.path.join(home, ".cache"),
+        "XDG_CONFIG_HOME": os.path.join(home, ".config"),
+        "XDG_DATA_HOME": os.path.join(home, ".local", "share"),
+        "XDG_CONFIG_DIRS": os.path.join(tmpdir, "none"),
+        "XDG_DATA_DIRS": os.path.join(tmpdir, "none"),
+    })
+    os.environ.pop("DISPLAY", None)
+    return home
+
+def make_archives(tmpdir, members):
+    """Generate tar.gz and zip archives with given number of 10 KB members; return (paths, total bytes)."""
+    srcdir = os.path.join(tmpdir, "src%d" % members)
+    data = os.urandom(5 * 1024) * 2
+    for i in range(members):
+        subdir = os.path.join(srcdir, "d%d" % (i // 100))
+        if not os.path.isdir(subdir):
+            os.makedirs(subdir)
+        with open(os.path.join(subdir, "f%d" % i), "wb") as f:
+            f.write(data)
+    tarname = srcdir + ".tar.gz"
+    with tarfile.open(tarname, "w:gz") as tar:
+        tar.add(srcdir, "src")
+    zipname = srcdir + ".zip"
+    with zipfile.ZipFile(zipname, "w", zipfile.ZIP_DEFLATED) as zf:
+        for dirpath, dirnames, filenames in os.walk(srcdir):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                zf.write(path, os.path.relpath(path, srcdir))
+    shutil.rmtree(srcdir)
+    return [tarname, zipname], members * len(data)
+
+def make_history(home, lines):
+    with open(os.path.join(home, ".bash_history"), "w") as f:
+        for i in range(lines):
+            f.write("command number %d --with some args\n" % (i % (lines // 2 or 1)))
+
+def make_images(tmpdir, images):
+    root = os.path.join(tmpdir, "images%d" % images)
+    for i in range(images):
+        subdir = os.path.join(root, "d%d" % (i // 500), "e%d" % (i // 50))
+        if not os.path.isdir(subdir):
+            os.makedirs(subdir)
+        open(os.path.join(subdir, "img%d.jpg" % i), "w").close()
+    return root
+
+def measure(func, repeat, setup=None):
+    """Return median wall time (seconds) of func() over repeat runs (setup() is run before every run, not measured)."""
+    times = []
+    for i in range(repeat):
+        if setup:
+            setup()
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+def benchmarks(tmpdir, home, sizes):
+    """Yield (name, func, setup, repeat, throughput) for all benchmarks.
+
+    setup - None or function called before every run of func (not measured)
+    repeat - None (use --repeat) or fixed number of runs (for benchmarks which change their data)
+    throughput - None or function returning throughput description for given time per call
+    Data for every size is generated lazily, so benchmarks filtered out by --only cost (almost) nothing.
+    """
+    python = sys.executable
+    script = os.path.join(REPO, "ml", "cmd.py")
+    textfile = os.path.join(tmpdir, "file.txt")
+    with open(textfile, "w") as f:
+        f.write("hello\n")
+    size = 64 * 1024 * 1024
+
+    yield "coldstart.version", lambda: subprocess.check_call([python, script, "--version"], stdout=subprocess.PIPE), None, None, None
+    yield "coldstart.edit", lambda: subprocess.check_call([python, script, "e", textfile]), None, None, None
+    yield "main.dispatch.hist", lambda: cmd.main(["cmd", "hist", "dispatch test"]), None, None, None
+    yield "run", lambda: cmd.run("true").wait(), None, None, None
+    yield "shell", lambda: cmd.shell("true"), None, None, None
+    yield ("shell_iter.memview", lambda: [None for chunk in cmd.shell_iter("head -c %d /dev/zero" % size, memview=True)], None, None,
+           lambda t: "%.0f MB/s" % (size / t / 1e6))
+    yield "edit.spawn", lambda: cmd.edit(textfile), lambda: cmd._vim_channel_open("EDITOR"), None, None
+    yield "openf", lambda: cmd.openf(textfile).wait(), None, None, None
+    yield "openf.url", lambda: cmd.openf("https://example.org").wait(), None, None, None
+
+    for sizename in sizes:
+        params = SIZES[sizename]
+        data = {}
+
+        def archive(kind, params=params, data=data):
+            if "archives" not in data:
+                data["archives"] = make_archives(tmpdir, params["members"])
+            (tarname, zipname), total = data["archives"]
+            return tarname if kind == "tar.gz" else zipname
+
+        def images(params=params, data=data):
+            if "images" not in data:
+                data["images"] = make_images(tmpdir, params["images"])
+            return data["images"]
+
+        for kind in ["tar.gz", "zip"]:
+            total = params["members"] * 10 * 1024
+            yield ("decomp.%s.%s" % (kind, sizename), lambda kind=kind: cmd.decomp(archive(kind), archive(kind) + ".dir"),
+                   lambda kind=kind: shutil.rmtree(archive(kind) + ".dir", True), None,
+                   lambda t, params=params, total=total: "%.0f MB/s, %.0f entries/s" % (total / t / 1e6, params["members"] / t))
+            yield "arclist.%s.%s" % (kind, sizename), lambda kind=kind: cmd.archive_list(archive(kind)), None, None, None
+
+        def histsetup(params=params, data=data):
+            if "history" not in data:
+                data["history"] = make_history(home, params["history"])
+            cmd._hist_index.update(file=None)
+
+        yield "hist.%s" % sizename, lambda: cmd.hist("new command %f" % time.time()), histsetup, None, None
+        yield ("hist_compact.%s" % sizename, cmd.hist_compact, lambda params=params: make_history(home, params["history"]), 1,
+               lambda t, params=params: "%.0f lines/s" % (params["history"] / t))
+
+        def coldsetup(images=images):
+            cachename = cmd._cachefile("fehback", images())
+            if os.path.exists(cachename):
+                os.remove(cachename)
+
+        yield "fehback.cold.%s" % sizename, lambda images=images: cmd.fehback_pick(images()), coldsetup, None, None
+        yield "fehback.warm.%s" % sizename, lambda images=images: cmd.fehback_pick(images()), images, None, None
+        yield "fehback.%s" % sizename, lambda images=images: cmd.fehback(images()), images, None, None
+
+def main():
+    args = cmd._docopt()(__doc__)
+    sizes = args["--sizes"].split(",")
+    only = args["--only"].split(",") if args["--only"] else None
+    baselinesname = args["--baselines"]
+    if not os.path.isabs(baselinesname):
+        baselinesname = os.path.join(REPO, baselinesname)
+    baselines = {}
+    if os.path.exists(baselinesname):
+        with open(baselinesname) as f:
+            baselines = json.load(f)
+    elif not args["--save"]:
+        print("No baselines in %s (create them with --save), nothing to compare with" % baselinesname)
+
+    tmpdir = tempfile.mkdtemp(prefix="ml.cmd-bench-")
+    results = {}
+    regressions = []
+    try:
+        home = setup(tmpdir)
+        print("%-28s %12s %12s  %s" % ("BENCHMARK", "TIME[ms]", "BASELINE", "THROUGHPUT"))
+        for name, func, setupfunc, repeat, throughput in benchmarks(tmpdir, home, sizes):
+            if only and not any(name.startswith(o) for o in only):
+                continue
+            seconds = measure(func, repeat or int(args["--repeat"]), setupfunc)
+            results[name] = seconds
+            base = baselines.get(name)
+            flag = ""
+            if base and seconds > base * REGRESSION_FACTOR:
+                flag = "  REGRESSION"
+                regressions.append(name)
+            print("%-28s %12.3f %12s  %s%s" % (name, seconds * 1000, "%.3f" % (base * 1000) if base else "-", throughput(seconds) if throughput else "", flag))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(tmpdir, True)
+
+    if args["--save"]:
+        baselines.update(results)
+        with open(baselinesname, "w") as f:
+            json.dump(baselines, f, indent=4, sort_keys=True)
+        print("Baselines saved to " + baselinesname)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
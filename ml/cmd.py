@@ -7,38 +7,63 @@
 
     Usage:
         cmd ( run     | r  )  <subcmd> [<args>...]
-        cmd ( shell   | s  )  <subcmd> [<args>...]
+        cmd ( shell   | s  )  [argv] <subcmd> [<args>...]
         cmd ( term    | t  )           [<args>...]
-        cmd ( edit    | e  )  <file>
+        cmd ( edit    | e  )  [tabs | buffers] <files>...
         cmd ( openf   | o  )  <file>
         cmd ( lopenf  | lo )  <file>
-        cmd ( play    | p  )  <file>
+        cmd ( play    | p  )  <media>...
         cmd ( hist    | h  )  [<commands>...]
+        cmd histcompact [<limit>]
         cmd ( decomp  | de )  <file> [<dir>]
+        cmd ( decompall | da ) [recursive] <archives>...
+        cmd ( arclist | al )  <file>
+        cmd ( arcget  | ag )  <file> <member> [<dir>]
         cmd ( diff    | d  )  <file1> <file2> [<file3>]
-        cmd ( fmgr    | f  )  <dir>
-        cmd ( fehback | fb )  <dir>
+        cmd ( udiff   | ud )  <file1> <file2> [<file3>]
+        cmd ( fmgr    | f  )  <query>...
+        cmd ( fehback | fb )  [prescale] <dir>
         cmd ( usrcmd  | uc )  <ucmd> [<args>...]
+        cmd ps [all]
+        cmd stats
+        cmd batch [interleaved] [null] [(jobs <jobs>)] [<input>]
+        cmd daemon
         cmd [-h | --help | -v | --version]
 
     Options:
         -h, --help         Print the help page
         -v, --version      Print the version number
+        --profile-startup  Print startup time report for the command instead of running it
 
     Commands:
         run:               Run given command in new process (and return immediately).
         shell:             Run given command, wait for it, then print its output.
+                           argv: run it without shell, arguments as given; stages are separated by "|" arguments (see pipe)
         term:              Run the default terminal emulator in new process.
-        edit:              Run the best text editor (or open a file in existing instance).
-        openf:             Open file using best program available for given file type (now it is just:xdg-open)
-        lopenf:            Open file specified inside given file using best program available
-        play:              Play given multimedia file
+        edit:              Run the best text editor (or open files in existing instance); "-" reads file names from stdin
+                           (like grep -l output); tabs: every file in its own tab; buffers: only add them to the buffer list
+        openf:             Open file using best program available for given file type (like xdg-open, but without any shell)
+        lopenf:            Open file specified inside given file using best program available (or all links from a directory tree)
+        play:              Play given multimedia files (add them to playlist of running player)
         hist:              Adds given commands to bash history so they are easily available in new terminals by using up arrow key
+        histcompact:       Leave only last <limit> unique commands in bash history (default: 10000)
         decomp:            Decompress archive file. Supports all most popular archive types.
+        decompall:         Decompress many archives (or all archives in given directories) in parallel (optionally with nested archives)
+        arclist:           List members of given archive (from cached index)
+        arcget:            Extract one member of given archive (to <dir> or <file>.dir)
         diff:              Run the best text editor in diff mode.
-        fmgr:              Run the best file manager (or open a directory in existing instance).
-        fehback:           Set two random background images for two screens (using the "feh" app)
-        usrcmd:            Invokes user defined function with given string parameters (from ~/.usrcmd.py)
+        udiff:             Print differences between files (unified diff or three way diff like diff3)
+        fmgr:              Run the best file manager (or open a directory in existing instance);
+                           <query> is a directory or words matching a directory visited before (by fmgr, edit or decomp)
+        fehback:           Set two random background images for two screens (from given directory tree, using the "feh" app);
+                           prescale: prepare scaled copies of images in the tree (as many as the cache holds)
+        usrcmd:            Invokes user defined function with given string parameters (from ~/.usrcmd.py or ~/.usrcmd.d/*.py)
+                           (user functions are commands too, so "cmd myfunc a b" works and so does a "myfunc" symlink)
+        ps:                List running (or all) processes started by run (and commands using it) with their cpu and memory usage
+        stats:             Print p50/p95 latency of commands and of processes they spawned (from the trace log)
+        batch:             Run command lines from <input> (or stdin) in one process on a pool of <jobs> workers (like xargs -P);
+                           output is kept in order of commands unless interleaved; null: lines are NUL separated
+        daemon:            Serve commands from one warm process (clients fall back to running them directly)
 
 
     Convenient way to use it from shell level is to create some symlinks to it with
@@ -70,20 +95,26 @@
 
 VERSION='0.2.2'
 
-try:
-    from docopt import docopt
-except ImportError:
-    print 'This script needs a "docopt" module (http://docopt.org)'
-    raise
-
+import time
 
+_STARTED = time.time()
 
+# Only modules needed by (almost) everything are imported here; everything else is imported
+# by the functions that need it, so a single command doesn't pay for the others (see profile_startup).
 import sys
-import subprocess
 import os
-import random
-import imp
-from pprint import pprint
+
+STARTUP_BUDGET = 0.05 # seconds, see profile_startup
+
+_WARM = False # True in the daemon (and its forked children): commands find their modules loaded, so their imports are not recorded
+
+def _docopt():
+    try:
+        from docopt import docopt
+    except ImportError:
+        print('This script needs a "docopt" module (http://docopt.org)')
+        raise
+    return docopt
 
 def exp(path):
     """Expand shell variables, and user shortcuts (~ or ~user)"""
@@ -98,9 +129,340 @@ def run(cmd, *args):
     run("xclock")
     run("xterm")  - spawns new xterm in act. directory
     run("xterm", "-e", "ipython")
+
+    Returns the subprocess.Popen object. The process is registered in the process registry
+    and reaped in the background when it exits (see children and procs).
+    """
+
+    import subprocess
+    started = time.time()
+    proc = subprocess.Popen([cmd] + list(args))
+    _supervise(proc, [cmd] + list(args), started)
+    return proc
+
+PROCLOG_MAX = 1024 * 1024 # bytes; the process log is compacted when it gets bigger than that
+CHILDREN_KEEP = 200 # how many records of finished processes the process registry keeps (newest ones)
+
+_children = {} # pid -> record (dict) of running and recently finished processes started by run in this python process
+_running = set() # pids of running children (the only ones the reaper looks at)
+_finished = [] # (pid, record) of finished children, oldest first (for dropping old records)
+_reaper = None
+
+def _proclog():
+    return os.path.join(_rundir(), "ml.cmd-procs.jsonl")
+
+def _proclog_write(record):
+    """Append record to the process log shared by all ml.cmd users (see procs)."""
+    import json
+    import fcntl
+    with open(_proclog(), "a") as log:
+        fcntl.flock(log, fcntl.LOCK_EX)
+        log.write(json.dumps(record) + "\n")
+        compact = log.tell() > PROCLOG_MAX
+    if compact:
+        _proclog_compact()
+
+def _proclog_compact(keep=200):
+    """Rewrite the process log with running processes and keep newest records of finished ones.
+
+    Processes which are not running any more without a recorded exit (like ones started from
+    the command line, whose owner exits right away) are finished with exitcode "?" here.
     """
+    import json
+    import fcntl
+    with open(_proclog(), "r+") as log:
+        fcntl.flock(log, fcntl.LOCK_EX)
+        records = _proclog_replay(log)
+        for record in records:
+            if record.get("exitcode", 0) is None and not _proc_alive(record):
+                record["exitcode"] = "?"
+        running = [r for r in records if r.get("exitcode", 0) is None]
+        finished = [r for r in records if r.get("exitcode", 0) is not None][-keep:]
+        log.seek(0)
+        log.truncate()
+        for record in running + finished:
+            log.write(json.dumps(record) + "\n")
+
+def _proclog_replay(log):
+    import json
+    import collections
+    records = collections.OrderedDict()
+    for line in log:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue # torn line
+        key = (record["pid"], record["started"])
+        records.setdefault(key, {}).update(record)
+    return list(records.values())
+
+def _exitcode(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def _reap(pid, options=0):
+    """wait4 for given registered child and record its exit; return False if it is still running."""
+    try:
+        wpid, status, rusage = os.wait4(pid, options)
+    except OSError: # somebody else (like Popen.wait) reaped it already
+        _reaped(pid, None, None)
+        return True
+    if not wpid:
+        return False
+    _reaped(pid, status, rusage)
+    return True
+
+def _reaped(pid, status, rusage):
+    record = _children[pid]
+    proc = record.pop("proc", None)
+    _running.discard(pid)
+    _finished.append((pid, record))
+    while len(_finished) > CHILDREN_KEEP:
+        oldpid, oldrecord = _finished.pop(0)
+        if _children.get(oldpid) is oldrecord: # (not if the pid was reused by a newer child)
+            del _children[oldpid]
+    if status is None:
+        record["exitcode"] = proc.returncode if proc is not None and proc.returncode is not None else "?"
+        record["ended"] = time.time()
+        _proclog_write(record)
+        return
+    record["exitcode"] = _exitcode(status)
+    record["ended"] = time.time()
+    record["utime"] = rusage.ru_utime
+    record["stime"] = rusage.ru_stime
+    record["maxrss"] = rusage.ru_maxrss * 1024 # linux reports kilobytes
+    if proc is not None and proc.returncode is None:
+        proc.returncode = record["exitcode"]
+    _proclog_write(record)
+    _trace("run", os.path.basename(record["argv"][0]), record["argv"], record["started"],
+           wall=record["ended"] - record["started"], spawn=record["spawn"], exitcode=record["exitcode"])
+
+def _reap_pidfd(wakeup):
+    """Reaper loop: wait on pidfds of registered children (linux 5.3+, python 3.9+)."""
+    import select
+    poll = select.poll()
+    poll.register(wakeup, select.POLLIN)
+    pidfds = {}
+    polled = set() # children without pidfd (pidfd_open failed: ENOSYS on old kernels, EMFILE, ...) are checked twice a second
+    while True:
+        for pid in list(_running):
+            if pid not in pidfds.values() and pid not in polled:
+                try:
+                    fd = os.pidfd_open(pid)
+                except OSError:
+                    fd = None
+                if fd is not None:
+                    pidfds[fd] = pid
+                    poll.register(fd, select.POLLIN)
+                elif not _reap(pid, os.WNOHANG): # (never block here: other children wait for this thread)
+                    polled.add(pid)
+        for fd, event in poll.poll(500 if polled else None):
+            if fd == wakeup:
+                os.read(wakeup, 4096)
+                continue
+            poll.unregister(fd)
+            os.close(fd)
+            _reap(pidfds.pop(fd))
+        for pid in list(polled):
+            if _reap(pid, os.WNOHANG):
+                polled.discard(pid)
+
+def _reap_polling(wakeup):
+    """Reaper loop for systems without pidfd: check registered children every half a second."""
+    import select
+    while True:
+        select.select([wakeup], [], [], 0.5)
+        try:
+            os.read(wakeup, 4096)
+        except OSError:
+            pass
+        for pid in list(_running):
+            _reap(pid, os.WNOHANG)
+
+def _supervise(proc, argv, started):
+    """Register given subprocess.Popen (started at given time) in the process registry and make sure it is reaped."""
+    global _reaper
+    import threading
+    now = time.time()
+    record = {"pid": proc.pid, "argv": argv, "started": started, "spawn": now - started, "owner": os.getpid(), "exitcode": None,
+              "starttime": _proc_starttime(proc.pid)}
+    _proclog_write(record)
+    record["proc"] = proc
+    _children[proc.pid] = record
+    _running.add(proc.pid)
+    if _reaper is None or _reaper[0] != os.getpid(): # (after fork we need our own thread)
+        rfd, wfd = os.pipe()
+        if os.name == "posix":
+            import fcntl
+            fcntl.fcntl(rfd, fcntl.F_SETFL, fcntl.fcntl(rfd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        thread = threading.Thread(target=_reap_pidfd if hasattr(os, "pidfd_open") else _reap_polling, args=(rfd,))
+        thread.daemon = True
+        thread.start()
+        _reaper = (os.getpid(), wfd)
+    os.write(_reaper[1], b"x")
+
+def children(running=None):
+    """Return records of processes started by run in this python process (running ones and CHILDREN_KEEP newest finished ones).
+
+    running - if True (False) return only running (finished) processes
+    Every record is a dict with keys: pid, argv, started, exitcode (None if still running)
+    and (after exit) ended, utime, stime (cpu seconds) and maxrss (bytes).
+    """
+    records = [dict((k, v) for k, v in r.items() if k != "proc") for r in list(_children.values())]
+    if running is not None:
+        records = [r for r in records if (r["exitcode"] is None) == running]
+    return sorted(records, key=lambda r: r["started"])
+
+def _proc_stat(pid):
+    """Return fields of /proc/PID/stat following the command name (state, ppid, ...) or None if there is no such process."""
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            return f.read().rsplit(")", 1)[1].split()
+    except (IOError, OSError, IndexError):
+        return None
+
+def _proc_starttime(pid):
+    """Return start time of a process (clock ticks after boot) or None; together with pid it identifies the process."""
+    fields = _proc_stat(pid)
+    return int(fields[19]) if fields else None
+
+def _proc_alive(record):
+    """Is the process of given process log record still running (and not some other process which got its pid)?
+
+    Zombies are not running (they only wait to be reaped by their parent - or by init, which may take a while).
+    """
+    fields = _proc_stat(record["pid"])
+    return fields is not None and fields[0] not in ("Z", "X") and record.get("starttime") in (None, int(fields[19]))
+
+def _proc_usage(pid):
+    """Return (cpu seconds, rss bytes) of a running process (from /proc) or (None, None)."""
+    fields = _proc_stat(pid)
+    if fields is None:
+        return None, None
+    return (float(fields[11]) + float(fields[12])) / os.sysconf("SC_CLK_TCK"), int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+
+def procs(running=None):
+    """Return records of processes started by run in any python process (of this user, since last reboot).
+
+    Records are like in children, with one more key: owner (pid of the process which called run).
+    Processes whose owner exited before them were reaped by init: their exitcode is "?".
+    For running processes utime is the current cpu time and maxrss is the current rss.
+    """
+    try:
+        with open(_proclog()) as log:
+            records = _proclog_replay(log)
+    except (IOError, OSError):
+        records = []
+    for record in records:
+        if record.get("exitcode") is None:
+            cpu, rss = _proc_usage(record["pid"]) if _proc_alive(record) else (None, None)
+            if cpu is None:
+                record["exitcode"] = "?"
+            else:
+                record["utime"], record["maxrss"] = cpu, rss
+    if running is not None:
+        records = [r for r in records if (r["exitcode"] is None) == running]
+    return records
+
+def ps(all=False):
+    """Print processes started by run (only running ones unless all is True), most cpu hungry first."""
+    records = procs(None if all else True)
+    records.sort(key=lambda r: (r.get("utime") or 0) + (r.get("stime") or 0), reverse=True)
+    print("%7s %5s %9s %9s %9s  %s" % ("PID", "EXIT", "CPU[s]", "RSS[MB]", "AGE[s]", "COMMAND"))
+    now = time.time()
+    for r in records:
+        print("%7d %5s %9.2f %9.1f %9d  %s" % (
+            r["pid"], "" if r["exitcode"] is None else r["exitcode"],
+            (r.get("utime") or 0) + (r.get("stime") or 0), (r.get("maxrss") or 0) / 1048576.0,
+            r.get("ended", now) - r["started"], " ".join(r["argv"])))
+
+TRACE_LOG = True # write trace events to the trace log (see stats); the in-memory ring buffer is always there
+TRACE_LOG_MAX = 1024 * 1024 # bytes; the trace log is rotated (to trace.jsonl.1) when it gets bigger than that
+TRACE_RING = 1000 # number of newest trace events kept in memory (see traces)
+TRACE_HOOKS = [] # functions called with every trace event, like: TRACE_HOOKS.append(lambda event: print(event))
+
+_traces = None
+
+def _tracelog():
+    return os.path.join(_cachedir(), "trace.jsonl")
+
+def _trace(kind, name, argv, started, **fields):
+    """Record a trace event: one command dispatched by main or one process spawned by run, shell, etc.
+
+    Every event is a dict with keys: kind ("command", "run", "shell"), name, argv, started, wall (seconds),
+    pid (of the tracing process) and (if known) spawn (seconds spent starting the process),
+    exitcode and output (bytes read from the process).
+    """
+    global _traces
+    import collections
+    event = {"kind": kind, "name": name, "argv": argv, "started": started, "pid": os.getpid()}
+    event["wall"] = time.time() - started
+    event.update(fields)
+    if _traces is None:
+        _traces = collections.deque(maxlen=TRACE_RING)
+    _traces.append(event)
+    for hook in TRACE_HOOKS:
+        hook(event)
+    if TRACE_LOG:
+        import json
+        import fcntl
+        try:
+            with open(_tracelog(), "a") as log:
+                fcntl.flock(log, fcntl.LOCK_EX)
+                log.write(json.dumps(event) + "\n")
+                if log.tell() > TRACE_LOG_MAX:
+                    os.rename(_tracelog(), _tracelog() + ".1")
+        except (IOError, OSError):
+            pass # tracing must never break the command itself
+
+def _trace_events():
+    """Return all trace events from the trace log (the rotated one first), oldest first."""
+    import json
+    events = []
+    for logname in [_tracelog() + ".1", _tracelog()]:
+        try:
+            with open(logname) as log:
+                for line in log:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        continue # torn line
+        except (IOError, OSError):
+            pass
+    return events
+
+def _imported_since(loaded):
+    """Names of modules imported since sys.modules held given names (in order of import where dicts keep it)."""
+    names = [name for name, mod in list(sys.modules.items()) if mod is not None and name not in loaded]
+    return names if sys.version_info >= (3, 7) else sorted(names) # (sorted: packages before their submodules)
+
+def traces():
+    """Return trace events recorded by this python process (newest TRACE_RING of them, oldest first)."""
+    return list(_traces or [])
+
+def _percentile(values, p):
+    """Nearest-rank percentile of sorted values."""
+    return values[min(len(values) - 1, int(p * len(values)))]
 
-    subprocess.Popen([cmd] + list(args))
+def stats(events=None):
+    """Print count, p50 and p95 wall time (and p50 spawn time) per command and per spawned program.
+
+    events - trace events to summarize (default: all from the trace log, including the rotated one)
+    """
+    if events is None:
+        events = _trace_events()
+    groups = {}
+    for event in events:
+        groups.setdefault((event["kind"], event["name"]), []).append(event)
+    print("%-8s %-20s %6s %6s %10s %10s %10s" % ("KIND", "NAME", "COUNT", "FAILED", "P50[ms]", "P95[ms]", "SPAWN[ms]"))
+    for (kind, name), group in sorted(groups.items()):
+        walls = sorted(e["wall"] for e in group)
+        spawns = sorted(e["spawn"] for e in group if e.get("spawn") is not None)
+        failed = len([e for e in group if e.get("exitcode") not in (0, None)])
+        print("%-8s %-20s %6d %6d %10.1f %10.1f %10s" % (
+            kind, name, len(group), failed, _percentile(walls, 0.5) * 1000, _percentile(walls, 0.95) * 1000,
+            "%.1f" % (_percentile(spawns, 0.5) * 1000) if spawns else ""))
 
 def shell(cmd):
     """Run given command using system shell, wait for it, and return a string containing the output.
@@ -110,82 +472,1746 @@ def shell(cmd):
     print shell("ls -a")
     print shell("ls -a | grep bla")
     """
-    return subprocess.check_output(cmd, shell=True)
+    import subprocess
+    started = time.time()
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+    spawn = time.time() - started
+    out = proc.communicate()[0]
+    _trace("shell", cmd.split(" ", 1)[0], ["sh", "-c", cmd], started, spawn=spawn, exitcode=proc.returncode, output=len(out))
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, out)
+    return out
+
+SHELL_CACHE_SIZE = 128 # number of outputs kept by shell_cached (least recently used ones are dropped)
+SHELL_CACHE_TTL = 10 # seconds; default time for which shell_cached trusts a cached output
+
+_shell_cache = None # (cmd, cwd, env) -> (expires, dependency mtimes, output); in least recently used first order
+_shell_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+def shell_cached(cmd, ttl=SHELL_CACHE_TTL, deps=(), env=()):
+    """Like shell, but return remembered output if the same command was run recently (for read only commands).
+
+    The output is remembered per command, current directory and values of given environment variables.
+    ttl - seconds for which the output is valid
+    deps - files or directories; the output is invalid as soon as any of them changes its mtime (or appears or disappears)
+    env - names of environment variables the output depends on
+    Failing commands are not remembered. See shell_cache_info and shell_cache_clear.
+
+    Examples:
+    shell_cached("git status -s", deps=[".git/index", ".git/HEAD"])
+    shell_cached("ls ~/bin", ttl=60, deps=[exp("~/bin")])
+    """
+    global _shell_cache
+    if _shell_cache is None:
+        import collections
+        _shell_cache = collections.OrderedDict()
+    key = (cmd, os.getcwd(), tuple((name, os.environ.get(name)) for name in env))
+    entry = _shell_cache.pop(key, None)
+    now = time.time()
+    mtimes = _mtimes(deps) if deps else None
+    if entry is not None and entry[0] > now and entry[1] == mtimes:
+        _shell_cache[key] = entry # (now it is the most recently used one)
+        _shell_cache_stats["hits"] += 1
+        return entry[2]
+    _shell_cache_stats["misses"] += 1
+    out = shell(cmd)
+    _shell_cache[key] = (now + ttl, mtimes, out)
+    while len(_shell_cache) > SHELL_CACHE_SIZE:
+        _shell_cache.popitem(last=False)
+        _shell_cache_stats["evictions"] += 1
+    return out
+
+def shell_cache_info():
+    """Return dict with shell_cached statistics: hits, misses, evictions and size (number of remembered outputs)."""
+    info = dict(_shell_cache_stats)
+    info["size"] = len(_shell_cache or ())
+    return info
+
+def shell_cache_clear(cmd=None):
+    """Forget remembered outputs of given command (in any directory and environment) or of all commands."""
+    for key in list(_shell_cache or ()):
+        if cmd is None or key[0] == cmd:
+            del _shell_cache[key]
+
+BUFSIZE = 64 * 1024
+
+def shell_iter(cmd, lines=True, binary=False, memview=False, bufsize=BUFSIZE):
+    """Run given command using system shell and yield its output as soon as it arrives.
+
+    cmd - string command
+    lines - yield whole lines (default); if False, yield chunks of at most bufsize bytes as they come
+    binary - yield bytes instead of decoded (utf-8) text (on python 2 output is never decoded)
+    memview - yield memoryview objects pointing to one reused buffer (implies lines=False and binary=True);
+              the view is only valid until the next item is requested, so nothing is copied or decoded
+    bufsize - size of the read buffer
+    Raises subprocess.CalledProcessError after the last item if the command fails (like shell does).
+    Only bufsize bytes (or the longest line) are held in memory at once.
+
+    Examples:
+    for line in shell_iter("find / -name '*.log'"):
+        print(line.rstrip())
+    for chunk in shell_iter("cat /dev/sda1 | gzip", memview=True):
+        outfile.write(chunk)
+    """
+    import subprocess
+    import io
+    started = time.time()
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, bufsize=bufsize if lines and not memview else 0)
+    spawn = time.time() - started
+    output = 0
+    decoder = None
+    if not binary and not memview and bytes is not str:
+        import codecs
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    try:
+        if memview:
+            raw = io.FileIO(proc.stdout.fileno(), closefd=False)
+            buf = memoryview(bytearray(bufsize))
+            while True:
+                size = raw.readinto(buf)
+                if not size:
+                    break
+                output += size
+                yield buf[:size]
+        elif lines:
+            for line in iter(proc.stdout.readline, b""):
+                output += len(line)
+                yield decoder.decode(line) if decoder else line
+        else:
+            fd = proc.stdout.fileno()
+            while True:
+                chunk = os.read(fd, bufsize)
+                if not chunk:
+                    break
+                output += len(chunk)
+                yield decoder.decode(chunk) if decoder else chunk
+        if decoder:
+            rest = decoder.decode(b"", True)
+            if rest:
+                yield rest
+        if proc.wait():
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+    finally:
+        if proc.poll() is None: # consumer gave up early
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+        _trace("shell", cmd.split(" ", 1)[0], ["sh", "-c", cmd], started, spawn=spawn, exitcode=proc.returncode, output=output)
+
+def _pipe_end(target, mode, opened):
+    """File descriptor for stdin/stdout of a pipeline: target is a filename, an open file or a file descriptor."""
+    if isinstance(target, int):
+        return target
+    if hasattr(target, "fileno"):
+        if "w" in mode:
+            target.flush()
+        return target.fileno()
+    f = open(exp(target), mode)
+    opened.append(f)
+    return f.fileno()
+
+def pipe(*cmds, **options):
+    """Run given commands (argv lists) connected like cmd1 | cmd2 | ... in a shell, but without any shell.
+
+    Arguments are passed as they are (no quoting problems) and no /bin/sh process is started.
+    Processes are connected directly by OS pipes and files are handed to them as file descriptors,
+    so the data never goes through python (unless the output is returned).
+    Options:
+    input - bytes to feed to the first command
+    stdin - filename, open file or file descriptor for the first command (default: our stdin)
+    stdout - filename (truncated), open file or file descriptor for the last command,
+             None (default) to collect the output and return it as bytes, or False to use our stdout
+    check - raise subprocess.CalledProcessError if any command fails (default: True); a command killed
+            by SIGPIPE (because a later one exited without reading everything, like head) is not a failure
+    Returns the output (bytes) or None if it was not collected.
+
+    Examples:
+    pipe(["cat", "my file.txt"], ["grep", "-v", "a b"], ["sort"])
+    pipe(["sort", "-u"], stdin="names.txt", stdout="sorted.txt")
+    pipe(["gzip", "-c"], input=data, stdout="data.gz")
+    """
+    import subprocess
+    import signal
+    if not cmds or not all(cmds):
+        raise ValueError("empty command in pipeline")
+    input, stdout = options.get("input"), options.get("stdout")
+    opened = []
+    procs = []
+    started = time.time()
+    try:
+        prev = None
+        if input is not None:
+            prev = subprocess.PIPE
+        elif options.get("stdin") is not None:
+            prev = _pipe_end(options["stdin"], "rb", opened)
+        last = subprocess.PIPE if stdout is None else None if stdout is False else _pipe_end(stdout, "wb", opened)
+        # python 2 leaves SIGPIPE ignored in children, so they wouldn't stop when the next command exits
+        restore = None if bytes is not str else lambda: signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+        try:
+            for i, argv in enumerate(cmds):
+                proc = subprocess.Popen(list(argv), stdin=prev, stdout=last if i == len(cmds) - 1 else subprocess.PIPE,
+                                        close_fds=True, preexec_fn=restore)
+                if procs:
+                    procs[-1].stdout.close() # (only the next process holds it now, so the previous one gets SIGPIPE if it exits)
+                procs.append(proc)
+                prev = proc.stdout
+        except BaseException:
+            # a later command can't be started: the started ones would wait for their input (never fed or our tty) forever
+            if procs and procs[0].stdin:
+                procs[0].stdin.close()
+            for proc in procs:
+                try:
+                    proc.kill()
+                except OSError:
+                    pass
+            raise
+        spawn = time.time() - started
+        if input is not None:
+            import threading
+            def feed(f=procs[0].stdin):
+                try:
+                    f.write(input)
+                except (IOError, OSError): # the first command exited without reading everything
+                    pass
+                finally:
+                    try:
+                        f.close()
+                    except (IOError, OSError):
+                        pass
+            feeder = threading.Thread(target=feed)
+            feeder.daemon = True
+            feeder.start()
+        output = procs[-1].stdout.read() if stdout is None else None
+        if input is not None:
+            feeder.join()
+    finally:
+        for f in opened:
+            f.close()
+        for proc in procs:
+            if proc.stdout:
+                proc.stdout.close()
+            proc.wait()
+    argvs = [a for argv in cmds for a in list(argv) + ["|"]][:-1]
+    statuses = [p.returncode for p in procs[:-1] if p.returncode != -signal.SIGPIPE] + [procs[-1].returncode]
+    failed = [st for st in statuses if st]
+    _trace("pipe", " | ".join(os.path.basename(argv[0]) for argv in cmds), argvs, started,
+           spawn=spawn, exitcode=failed[-1] if failed else 0, output=None if output is None else len(output))
+    if failed and options.get("check", True):
+        raise subprocess.CalledProcessError(failed[-1], argvs, output)
+    return output
 
 def term(*args):
     """Run the default terminal emulator in new process."""
     run("x-terminal-emulator", *args)
 
+def _rundir():
+    """Private per user directory for sockets, fifos and other runtime files.
+
+    Raises OSError if it is not a real directory owned by us and closed to others
+    (anybody could create /tmp/ml.cmd-UID before us and listen there).
+    """
+    import stat
+    rundir = os.environ.get("XDG_RUNTIME_DIR") or "/tmp/ml.cmd-%d" % os.getuid()
+    try:
+        st = os.lstat(rundir)
+    except OSError:
+        _makedirs(rundir)
+        os.chmod(rundir, 0o700)
+        st = os.lstat(rundir)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise OSError("Refusing to use runtime directory not private to this user: " + rundir)
+    return rundir
+
+def _vim_channel(servername):
+    return os.path.join(_rundir(), "ml.cmd-vim-" + servername + ".fifo")
+
+def _vim_channel_setup(servername):
+    """Vim command (for --cmd) which makes new vim server listen on its channel (a fifo read by a vim job).
+
+    Every line written to the fifo is: <ex command> TAB <file name>, for example: drop<TAB>/home/me/.bashrc
+    Vim records its pid next to the fifo, so we can tell when the server disappears without asking X.
+    """
+    fifo = _vim_channel(servername).replace("'", "''")
+    return ("if has('job') | call writefile([getpid()], '" + fifo + ".pid') | "
+            "let g:mlcmd_channel = job_start(['sh', '-c', 'exec cat <> \"$0\"', '" + fifo + "'], {'out_cb': "
+            "{ch, msg -> [execute(substitute(msg, '\\t.*', '', '') . ' ' . fnameescape(substitute(msg, '^[^\\t]*\\t', '', ''))), "
+            "foreground()]}}) | endif")
+
+def _vim_channel_open(servername):
+    """Open channel of given vim server for writing (or return None and forget the channel if the server is gone)."""
+    import errno
+    fifo = _vim_channel(servername)
+    try:
+        with open(fifo + ".pid") as f:
+            os.kill(int(f.read().split()[0]), 0)
+        fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+    except (IOError, OSError, ValueError, IndexError) as e:
+        if getattr(e, "errno", None) != errno.ENOENT:
+            for path in (fifo, fifo + ".pid"):
+                if os.path.lexists(path):
+                    os.unlink(path)
+        return None
+    import fcntl
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+    return fd
+
+def vim_servers():
+    """Return names of running vim servers registered by edit (without starting any process)."""
+    prefix, suffix = "ml.cmd-vim-", ".fifo"
+    names = [f[len(prefix):-len(suffix)] for f in os.listdir(_rundir()) if f.startswith(prefix) and f.endswith(suffix)]
+    servers = []
+    for name in names:
+        fd = _vim_channel_open(name)
+        if fd is not None:
+            os.close(fd)
+            servers.append(name)
+    return servers
+
+def vim_send(servername, filenames, excmd="drop"):
+    """Open given files in running vim server through its channel (no process is started).
+
+    Returns False if there is no such server (or it was not started by edit), True otherwise.
+    """
+    import select
+    fd = _vim_channel_open(servername)
+    if fd is None:
+        return False
+    try:
+        # whole lines, at most PIPE_BUF bytes per write, so lines from concurrent writers are not mixed
+        pipebuf = getattr(select, "PIPE_BUF", 512)
+        chunk = b""
+        for filename in filenames:
+            line = (excmd + "\t" + os.path.abspath(filename) + "\n").encode("utf-8")
+            if chunk and len(chunk) + len(line) > pipebuf:
+                os.write(fd, chunk)
+                chunk = b""
+            chunk += line
+        if chunk:
+            os.write(fd, chunk)
+    finally:
+        os.close(fd)
+    return True
+
+VIM_SERVERLIST_TTL = 2 # seconds for which is_vim_running trusts "vim --serverlist" output (edit forgets it when it starts a vim)
+
 def is_vim_running(servername):
-    servers = shell("vim --serverlist").split('\n')
+    fd = _vim_channel_open(servername)
+    if fd is not None:
+        os.close(fd)
+        return True
+    servers = shell_cached("vim --serverlist", ttl=VIM_SERVERLIST_TTL, env=["DISPLAY"]).decode("utf-8", "replace").split('\n')
     return servername in servers
     
 
+def _edit_visit(filenames):
+    dirnames = []
+    for f in filenames:
+        dirname = f if os.path.isdir(f) else os.path.dirname(os.path.abspath(f))
+        if dirname not in dirnames:
+            dirnames.append(dirname)
+    try:
+        dirs_visit(*dirnames)
+    except (IOError, OSError):
+        pass # (the frecency index is just a convenience)
+
 def edit(filename, vimexecname="gvim", vimservername="EDITOR", addfilenames=[]):
     """Run the best text editor (or open a file in existing instance)."""
 
+    filenames = [filename] + list(addfilenames)
+    _edit_visit(filenames)
+    if vim_send(vimservername, filenames):
+        return
     cmd = [vimexecname, "--servername", vimservername]
     if is_vim_running(vimservername):
         cmd.append("--remote")
-    cmd.append(filename)
-    for afn in addfilenames:
-        cmd.append(afn)
+    else:
+        fifo = _vim_channel(vimservername)
+        if os.path.lexists(fifo):
+            os.unlink(fifo)
+        os.mkfifo(fifo, 0o600)
+        cmd += ["--cmd", _vim_channel_setup(vimservername)]
+        shell_cache_clear("vim --serverlist")
+    cmd += filenames
     run(*cmd)
 
     #TODO: activate editor window if under qtile
  
+EDIT_PLACEMENTS = {
+    # placement -> (ex command for the vim channel, --remote option for other servers, option for new vim)
+    "window": ("drop", "--remote-silent", None),
+    "tab": ("tab drop", "--remote-tab-silent", "-p"),
+    "buffer": ("badd", None, None),
+}
+EDIT_START_TIMEOUT = 10 # seconds to wait for a new vim server to open its channel (see edit_many)
+
+def _arg_max():
+    """Bytes we can use for command line arguments (ARG_MAX minus environment and some reserve)."""
+    try:
+        argmax = os.sysconf("SC_ARG_MAX")
+    except (ValueError, OSError):
+        argmax = 128 * 1024
+    env = sum(len(k) + len(v) + 2 + 8 for k, v in os.environ.items())
+    return max(4096, min(argmax - env - 4096, 2 * 1024 * 1024))
+
+def _arg_chunks(args, size):
+    """Split args into lists which take at most size bytes each on a command line (strings plus pointers)."""
+    chunk, used = [], 0
+    for arg in args:
+        n = len(_bytes(arg)) + 1 + 8
+        if chunk and used + n > size:
+            yield chunk
+            chunk, used = [], 0
+        chunk.append(arg)
+        used += n
+    if chunk:
+        yield chunk
+
+def _vim_fnameescape(filename):
+    return "".join("\\" + c if c in " \t\n*?[{`$\\%#'\"|!<" else c for c in filename)
+
+def edit_files(lines):
+    """Unique real paths of files from given iterable of file names (like lines of grep -l output), in given order."""
+    seen = set()
+    filenames = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line:
+            continue
+        path = os.path.realpath(exp(line))
+        if path not in seen:
+            seen.add(path)
+            filenames.append(path)
+    return filenames
+
+def edit_many(filenames, placement="window", vimexecname="gvim", vimservername="EDITOR"):
+    """Open many files (thousands are fine) in the editor server with as few processes as possible.
+
+    filenames - file names; they are deduplicated and resolved (see edit_files)
+    placement - "window": open the first one like edit does and the rest in the background,
+                "tab": every file in its own tab, "buffer": just add them to the buffer list
+    Files are sent through the vim channel (see vim_send) when the server was started by edit, so no process
+    is started at all. Otherwise they are passed to "gvim --remote..." in chunks which fit in ARG_MAX.
+    When there is no server, it is started with the first chunk and the rest is sent through its channel.
+    Returns the number of files.
+    """
+    excmd, remote, newopt = EDIT_PLACEMENTS[placement]
+    filenames = edit_files(filenames)
+    if not filenames:
+        return 0
+    _edit_visit(filenames)
+    if placement == "window": # (the first file is shown, the others are only loaded)
+        first, rest = [filenames[0]], filenames[1:]
+        if vim_send(vimservername, first):
+            vim_send(vimservername, rest, "badd")
+            return len(filenames)
+    elif vim_send(vimservername, filenames, excmd):
+        return len(filenames)
+    argmax = _arg_max()
+    cmd = [vimexecname, "--servername", vimservername]
+    if is_vim_running(vimservername):
+        if remote:
+            for chunk in _arg_chunks(filenames, argmax - len(" ".join(cmd + [remote])) - 1):
+                run(*cmd + [remote] + chunk).wait()
+        else:
+            commands = ["badd " + _vim_fnameescape(f).replace("<", "<lt>") for f in filenames]
+            for chunk in _arg_chunks(commands, min(argmax, 120 * 1024)): # (one argument can't be longer than 128 KB)
+                run(*cmd + ["--remote-send", "<C-\\><C-N>:" + "|".join(chunk) + "<CR>"]).wait()
+        return len(filenames)
+    fifo = _vim_channel(vimservername)
+    if os.path.lexists(fifo):
+        os.unlink(fifo)
+    os.mkfifo(fifo, 0o600)
+    cmd += ["--cmd", _vim_channel_setup(vimservername)] + ([newopt] if newopt else [])
+    chunks = _arg_chunks(filenames, argmax - len(_bytes(" ".join(cmd))) - 1)
+    first = next(chunks)
+    shell_cache_clear("vim --serverlist")
+    run(*cmd + first)
+    rest = [f for chunk in chunks for f in chunk]
+    if rest:
+        deadline = time.time() + EDIT_START_TIMEOUT
+        while not vim_send(vimservername, rest, excmd if placement != "window" else "badd"):
+            if time.time() > deadline:
+                raise RuntimeError("vim server %s didn't open its channel, %d files not opened" % (vimservername, len(rest)))
+            time.sleep(0.05)
+    return len(filenames)
+
+MAGIC = [
+    (b"%PDF-", "application/pdf"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"PK\x03\x04", "application/zip"),
+    (b"\x1f\x8b", "application/gzip"),
+    (b"BZh", "application/x-bzip2"),
+    (b"\xfd7zXZ\x00", "application/x-xz"),
+    (b"Rar!\x1a\x07", "application/vnd.rar"),
+    (b"7z\xbc\xaf\x27\x1c", "application/x-7z-compressed"),
+    (b"\x7fELF", "application/x-executable"),
+    (b"ID3", "audio/mpeg"),
+    (b"fLaC", "audio/flac"),
+    (b"OggS", "audio/ogg"),
+    (b"\x1aE\xdf\xa3", "video/x-matroska"),
+    (b"<?xml", "application/xml"),
+    (b"<!DOCTYPE html", "text/html"),
+    (b"<html", "text/html"),
+    (b"#!", "application/x-shellscript"),
+]
+
+def _textopen(path):
+    if bytes is str:
+        return open(path)
+    import io
+    return io.open(path, encoding="utf-8", errors="replace")
+
+def _xdg_dirs(kind):
+    """Return XDG config ("config") or data ("data") directories, most important first."""
+    if kind == "config":
+        home = os.environ.get("XDG_CONFIG_HOME") or exp("~/.config")
+        dirs = os.environ.get("XDG_CONFIG_DIRS") or "/etc/xdg"
+    else:
+        home = os.environ.get("XDG_DATA_HOME") or exp("~/.local/share")
+        dirs = os.environ.get("XDG_DATA_DIRS") or "/usr/local/share:/usr/share"
+    return [home] + [d for d in dirs.split(":") if d]
+
+def _ini_sections(path):
+    """Parse simple ini file (like mimeapps.list or .desktop file) into dict: section -> dict."""
+    sections = {}
+    section = None
+    with _textopen(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("[") and line.endswith("]"):
+                section = sections.setdefault(line[1:-1], {})
+            elif section is not None and "=" in line:
+                key, value = line.split("=", 1)
+                section.setdefault(key.strip(), value.strip())
+    return sections
+
+def _mime_sources():
+    """Return (mimeapps.list files, application directories), most important first (only existing ones)."""
+    lists = []
+    for d in _xdg_dirs("config"):
+        lists.append(os.path.join(d, "mimeapps.list"))
+    for d in _xdg_dirs("data"):
+        lists.append(os.path.join(d, "applications", "mimeapps.list"))
+        lists.append(os.path.join(d, "applications", "defaults.list"))
+    appdirs = [os.path.join(d, "applications") for d in _xdg_dirs("data")]
+    return [f for f in lists if os.path.isfile(f)], [d for d in appdirs if os.path.isdir(d)]
+
+def _mtimes(paths):
+    mtimes = {}
+    for path in paths:
+        try:
+            mtimes[path] = os.stat(path).st_mtime
+        except OSError:
+            pass
+    return mtimes
+
+def _mime_index():
+    """Load (or build) the cached index of mime associations and desktop applications.
+
+    Returns dict with keys: "defaults", "added", "removed" (mime -> list of desktop ids, from mimeapps.list files),
+    "apps" (desktop id -> (Exec, Terminal, Name, Icon, path)), "mimes" (mime -> desktop ids declaring it).
+    The index is rebuilt when any of the mimeapps.list files, application directories or desktop files changes.
+    """
+    lists, appdirs = _mime_sources()
+    cachename = _cachefile("mime", ":".join(lists + appdirs))
+    index = _cache_load(cachename)
+    if index and _mtimes(index["sources"]) == index["sources"] and set(index["sources"]) >= set(lists + appdirs):
+        return index
+
+    index = {"defaults": {}, "added": {}, "removed": {}, "apps": {}, "mimes": {}}
+    sources = lists + appdirs
+    for path in lists:
+        sections = _ini_sections(path)
+        for section, key in [("Default Applications", "defaults"), ("Added Associations", "added"), ("Removed Associations", "removed")]:
+            for mime, ids in sections.get(section, {}).items():
+                index[key].setdefault(mime, []).extend(i for i in ids.split(";") if i)
+    for appdir in appdirs:
+        for dirpath, dirnames, filenames in os.walk(appdir):
+            sources.append(dirpath)
+            for name in filenames:
+                if not name.endswith(".desktop"):
+                    continue
+                path = os.path.join(dirpath, name)
+                appid = os.path.relpath(path, appdir).replace(os.sep, "-")
+                sources.append(path)
+                if appid in index["apps"]:
+                    continue # shadowed by the same id in more important directory
+                try:
+                    entry = _ini_sections(path).get("Desktop Entry", {})
+                except (IOError, OSError):
+                    continue
+                if entry.get("Type", "Application") != "Application" or entry.get("Hidden") == "true" or "Exec" not in entry:
+                    continue
+                index["apps"][appid] = (entry["Exec"], entry.get("Terminal") == "true", entry.get("Name", appid), entry.get("Icon", ""), path)
+                for mime in entry.get("MimeType", "").split(";"):
+                    if mime:
+                        index["mimes"].setdefault(mime, []).append(appid)
+    index["sources"] = _mtimes(sources)
+    _cache_save(cachename, index)
+    return index
+
+def _is_url(filename):
+    import re
+    return re.match(r"^[a-zA-Z][a-zA-Z0-9+.-]*://", filename) is not None or filename.startswith("mailto:")
+
+def mime_type(filename):
+    """Guess mime type of given file or url (from url scheme, file extension or first bytes of the file)."""
+    import mimetypes
+    if _is_url(filename):
+        scheme = filename.split(":", 1)[0].lower()
+        if scheme != "file":
+            return "x-scheme-handler/" + scheme
+        filename = _url_path(filename)
+    if os.path.isdir(filename):
+        return "inode/directory"
+    mime, encoding = mimetypes.guess_type(filename)
+    if mime:
+        return mime
+    try:
+        with open(filename, "rb") as f:
+            head = f.read(64)
+    except (IOError, OSError):
+        return "application/octet-stream"
+    for magic, mime in MAGIC:
+        if head.startswith(magic):
+            return mime
+    if head and b"\x00" not in head:
+        return "text/plain"
+    return "application/octet-stream"
+
+def _url_path(url):
+    try:
+        from urllib.parse import urlparse, unquote
+    except ImportError:
+        from urlparse import urlparse
+        from urllib import unquote
+    return unquote(urlparse(url).path)
+
+def mime_apps(mime):
+    """Return desktop ids of applications able to open given mime type, the best (default) one first."""
+    index = _mime_index()
+    candidates = []
+    for m in [mime, mime.split("/")[0] + "/*"] + (["text/plain"] if mime.startswith("text/") else []):
+        removed = set(index["removed"].get(m, []))
+        for key in ("defaults", "added", "mimes"):
+            candidates += [i for i in index[key].get(m, []) if i not in removed]
+    apps = []
+    for appid in candidates:
+        if appid in index["apps"] and appid not in apps:
+            apps.append(appid)
+    return apps
+
+def _app_argvs(appid, filenames):
+    """Expand Exec line of given desktop application for given files or urls into a list of argvs to run.
+
+    Applications accepting a list (%F, %U) get all files in one argv, others one argv per file.
+    """
+    import shlex
+    import re
+    execline, terminal, name, icon, path = _mime_index()["apps"][appid]
+    args = shlex.split(execline)
+    codes = set(a for a in args if a in ("%f", "%F", "%u", "%U"))
+    groups = [filenames] if codes & set(["%F", "%U"]) else [[f] for f in filenames]
+    argvs = []
+    for group in groups:
+        argv = []
+        for arg in args:
+            if arg in ("%f", "%F"):
+                argv += [_url_path(f) if f.startswith("file://") else f for f in group]
+            elif arg in ("%u", "%U"):
+                argv += group
+            elif arg == "%i":
+                argv += ["--icon", icon] if icon else []
+            else:
+                for code, value in (("%c", name), ("%k", path)):
+                    arg = arg.replace(code, value)
+                arg = re.sub(r"%[dDnNvm]", "", arg).replace("%%", "%")
+                if arg:
+                    argv.append(arg)
+        if not codes:
+            argv += group
+        if terminal:
+            argv = ["x-terminal-emulator", "-e"] + argv
+        argvs.append(argv)
+    return argvs
+
 def openf(filename):
-    """Open file (or url) using best available application. Current implementation just use xdg-open."""
+    """Open file (or url) using best available application (without any shell and without waiting for it).
 
-    shell("xdg-open '" + filename + "'")
+    The application is chosen like xdg-open does it (from mimeapps.list and .desktop files),
+    but from a cached index; if no application is found xdg-open is used. Returns the subprocess.Popen object.
+    """
+
+    filename = filename.strip()
+    apps = mime_apps(mime_type(filename))
+    if not apps:
+        return run("xdg-open", filename)
+    return run(*_app_argvs(apps[0], [filename])[0])
+
+def openf_many(filenames):
+    """Open many files (or urls) at once: each application is started once with all of its files if it can take a list.
+
+    Returns list of subprocess.Popen objects.
+    """
+    groups = {}
+    order = []
+    for filename in filenames:
+        apps = mime_apps(mime_type(filename))
+        app = apps[0] if apps else None
+        if app not in groups:
+            groups[app] = []
+            order.append(app)
+        groups[app].append(filename)
+    procs = []
+    for app in order:
+        if app is None:
+            procs += [run("xdg-open", f) for f in groups[app]]
+        else:
+            procs += [run(*argv) for argv in _app_argvs(app, groups[app])]
+    return procs
+
+def _normalize_link(link, basedir=None):
+    """Return normalized url (lowercase scheme and host, no default port) or absolute path for given link."""
+    if not _is_url(link):
+        return os.path.normpath(os.path.join(basedir or os.getcwd(), exp(link)))
+    try:
+        from urllib.parse import urlsplit, urlunsplit
+    except ImportError:
+        from urlparse import urlsplit, urlunsplit
+    parts = urlsplit(link)
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc
+    if "@" in netloc:
+        userinfo, host = netloc.rsplit("@", 1)
+        userinfo += "@"
+    else:
+        userinfo, host = "", netloc
+    host = host.lower()
+    default = {"http": ":80", "https": ":443", "ftp": ":21"}.get(scheme)
+    if default and host.endswith(default):
+        host = host[:-len(default)]
+    path = parts.path or ("/" if host else "")
+    return urlunsplit((scheme, userinfo + host, path, parts.query, parts.fragment))
+
+def lopenf_links(text, basedir=None):
+    """Return normalized links found in given .lopenf file content (separated by whitespace, usually one per line)."""
+    return [_normalize_link(link, basedir) for link in text.split()]
+
+def _lopenf_index(dirname):
+    """Return dict: .lopenf file path -> list of its links, for given directory tree (cached by files mtimes)."""
+    root = os.path.abspath(dirname)
+    cachename = _cachefile("lopenf-ws", root) # (links split on whitespace only)
+    oldindex = _cache_load(cachename, {})
+    index = {}
+    todo = [root]
+    while todo:
+        path = todo.pop()
+        for name, isdir in _scandir(path):
+            filename = os.path.join(path, name)
+            if isdir:
+                todo.append(filename)
+            elif name.endswith(".lopenf"):
+                st = os.stat(filename)
+                key = (st.st_mtime, st.st_size)
+                if filename in oldindex and tuple(oldindex[filename][:2]) == key:
+                    index[filename] = oldindex[filename]
+                else:
+                    with _textopen(filename) as f:
+                        index[filename] = (key[0], key[1], lopenf_links(f.read(), path))
+    if index != oldindex:
+        _cache_save(cachename, index)
+    return dict((f, index[f][2]) for f in index)
+
+def lopenf_tree(dirname):
+    """Open all links from all .lopenf files in given directory tree (each unique link once).
+
+    Links are passed to each application in one invocation where the application allows it.
+    """
+    index = _lopenf_index(dirname)
+    links = []
+    seen = set()
+    for filename in sorted(index):
+        for link in index[filename]:
+            if link not in seen:
+                seen.add(link)
+                links.append(link)
+    return openf_many(links)
 
 def lopenf(filename):
     """Open file or url specified inside given file using best available application.
     
     It can be useful for creating simple oneline files with links to web pages with special extension like .lopenf
     and to associate this kind of files with lopenf command, so if you click on such file, it will pop up your browser.
+    The file can contain more links (one per line). If a directory is given, links from all .lopenf files
+    in the directory tree are opened (see lopenf_tree).
     """
 
-    with open(exp(filename), "r") as link:
-        openf(link.read())
+    filename = exp(filename)
+    if os.path.isdir(filename):
+        return lopenf_tree(filename)
+    with _textopen(filename) as link:
+        links = lopenf_links(link.read(), os.path.dirname(os.path.abspath(filename)))
+    seen = set()
+    return openf_many([l for l in links if not (l in seen or seen.add(l))])
+
+PLAYERS = {"audio": "audacious", "video": "smplayer"} # media type -> player backend (see PLAYER_BACKENDS)
+
+PLAYER_BACKENDS = {
+    # start: command starting new instance, enqueue: options passing files to running instance (or starting it)
+    "smplayer": {"start": ["smplayer"], "enqueue": ["smplayer", "-add-to-playlist"]},
+    "audacious": {"start": ["audacious"], "enqueue": ["audacious", "--enqueue"]},
+    # ipc: files are appended through mpv's json ipc socket (no process started at all)
+    "mpv": {"start": ["mpv", "--idle=once", "--force-window", "--input-ipc-server={socket}"], "ipc": "mpv"},
+}
+
+def _mpv_enqueue(sockname, filenames):
+    """Append files to playlist of mpv listening on given socket; return False if there is no such mpv."""
+    import socket
+    import json
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(sockname)
+    except socket.error:
+        sock.close()
+        return False
+    try:
+        sock.sendall(b"".join(_bytes(json.dumps({"command": ["loadfile", os.path.abspath(f), "append-play"]}) + "\n") for f in filenames))
+    finally:
+        sock.close()
+    return True
+
+def media_type(filename):
+    """Return "audio" or "video" (default for anything unknown) for given media file."""
+    return "audio" if mime_type(filename).startswith("audio/") else "video"
+
+def media_files(*patterns):
+    """Expand given files, directories (recursively) and glob patterns into a sorted list of media files."""
+    import glob
+    filenames = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            found = []
+            for dirpath, dirnames, names in os.walk(pattern):
+                found += [os.path.join(dirpath, n) for n in names if mime_type(os.path.join(dirpath, n)).split("/")[0] in ("audio", "video")]
+            filenames += sorted(found)
+        elif not os.path.exists(pattern) and glob.has_magic(pattern):
+            filenames += sorted(glob.glob(pattern))
+        else:
+            filenames.append(pattern)
+    return filenames
+
+def enqueue(*patterns):
+    """Add given media files (directories and globs are expanded) to playlists of running players.
+
+    Every file goes to the player for its media type (see PLAYERS). All files for one player are passed
+    in one batch: through the player's ipc socket (mpv) or one call of its enqueue command which hands
+    them over to the running instance (or starts it). Returns list of started subprocess.Popen objects.
+    """
+    groups = {}
+    order = []
+    for filename in media_files(*patterns):
+        player = PLAYERS[media_type(filename)]
+        if player not in groups:
+            groups[player] = []
+            order.append(player)
+        groups[player].append(filename)
+    procs = []
+    for player in order:
+        backend = PLAYER_BACKENDS[player]
+        filenames = groups[player]
+        if backend.get("ipc") == "mpv":
+            sockname = os.path.join(_rundir(), "ml.cmd-" + player + ".sock")
+            if _mpv_enqueue(sockname, filenames):
+                continue
+            procs.append(run(*[a.replace("{socket}", sockname) for a in backend["start"]] + filenames))
+        else:
+            procs.append(run(*backend["enqueue"] + filenames))
+    return procs
+
+def play(*filenames):
+    """Play given multimedia files (audio and video go to different players; directories and globs are expanded)."""
+    return enqueue(*filenames)
+
+HISTFILE = "~/.bash_history"
+HISTLIMIT = 10000 # number of unique commands kept by hist_compact
 
-def play(filename):
-    """Play given multimetia file."""
-    run("smplayer", filename) #TODO: run audacious for audio files
+_hist_pending = []
+_hist_index = {"file": None, "offset": 0, "hashes": set()}
 
-def hist(*commands):
-    """Add some commands to bash history. If user opens a new bash after, he will have quick access to those commands using the up arrow key."""
+def _bytes(text):
+    return text if isinstance(text, bytes) else text.encode("utf-8")
 
-    with open(exp("~/.bash_history"), "a") as histfile:
-        commands = "\n".join(commands) + "\n"
-        histfile.write(commands)
+def _hist_entries(lines):
+    """Group bash history lines into (lines, command) pairs (a timestamp comment belongs to the next command)."""
+    stamp = []
+    for line in lines:
+        if line[:1] == b"#" and line[1:].strip().isdigit():
+            stamp.append(line)
+            continue
+        yield stamp + [line], line.rstrip(b"\n")
+        stamp = []
 
+def _hist_lock(histname):
+    """Open history file for appending and lock it; reopen if somebody replaced it (see hist_compact) meanwhile."""
+    import fcntl
+    while True:
+        histfile = open(histname, "ab+")
+        fcntl.flock(histfile, fcntl.LOCK_EX)
+        try:
+            if os.fstat(histfile.fileno()).st_ino == os.stat(histname).st_ino:
+                return histfile
+        except OSError:
+            pass
+        histfile.close()
+
+def _hist_update_index(histfile):
+    """Bring in-process index of history commands up to date, reading only what was appended since last time."""
+    st = os.fstat(histfile.fileno())
+    if _hist_index["file"] != (st.st_dev, st.st_ino) or st.st_size < _hist_index["offset"]:
+        _hist_index.update(file=(st.st_dev, st.st_ino), offset=0, hashes=set())
+    histfile.seek(_hist_index["offset"])
+    for lines, command in _hist_entries(histfile):
+        _hist_index["hashes"].add(hash(command))
+    _hist_index["offset"] = histfile.tell()
+
+def hist_flush(dedup=True):
+    """Write commands buffered by hist(..., flush=False) to bash history (one locked append)."""
+    if not _hist_pending:
+        return
+    histfile = _hist_lock(exp(HISTFILE))
+    try:
+        if dedup:
+            _hist_update_index(histfile)
+        data = []
+        for command in _hist_pending:
+            key = hash(command)
+            if dedup and key in _hist_index["hashes"]:
+                continue
+            _hist_index["hashes"].add(key)
+            data.append(command + b"\n")
+        histfile.seek(0, os.SEEK_END)
+        histfile.write(b"".join(data))
+        histfile.flush()
+        if dedup:
+            _hist_index["offset"] = histfile.tell()
+    finally:
+        histfile.close()
+        del _hist_pending[:]
+
+def hist(*commands, **options):
+    """Add some commands to bash history. If user opens a new bash after, he will have quick access to those commands using the up arrow key.
+
+    Commands already in the history are skipped (unless dedup=False is given).
+    With flush=False commands are only buffered and written together later (by hist_flush or at exit).
+    Writers lock the history file, so commands from concurrent callers are never mixed.
+    """
+
+    dedup = options.get("dedup", True)
+    _hist_pending.extend(_bytes(c) for c in commands)
+    if options.get("flush", True):
+        hist_flush(dedup)
+    elif len(_hist_pending) == len(commands):
+        import atexit
+        atexit.register(hist_flush, dedup)
+
+def hist_compact(limit=HISTLIMIT):
+    """Rewrite bash history keeping only the last occurrence of each of the last limit unique commands.
+
+    The file is streamed twice (never loaded whole): first pass finds the last occurrence of every command,
+    second one copies the ones we keep to a new file which then atomically replaces the old one.
+    """
+    import tempfile
+    histname = os.path.realpath(exp(HISTFILE))
+    histfile = _hist_lock(histname)
+    try:
+        histfile.seek(0)
+        last = {}
+        for i, (lines, command) in enumerate(_hist_entries(histfile)):
+            last[hash(command)] = i
+        keep = set(sorted(last.values())[-limit:]) if limit > 0 else set()
+        last = None
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(histname), prefix=".bash_history.")
+        try:
+            with os.fdopen(fd, "wb") as tmpfile:
+                histfile.seek(0)
+                for i, (lines, command) in enumerate(_hist_entries(histfile)):
+                    if i in keep:
+                        tmpfile.writelines(lines)
+                tmpfile.flush()
+                os.fsync(tmpfile.fileno())
+            os.chmod(tmpname, os.fstat(histfile.fileno()).st_mode & 0o777)
+            os.rename(tmpname, histname)
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+        return len(keep)
+    finally:
+        histfile.close()
+
+
+ARCHIVE_TYPES = [
+    (".tar", "tar"),
+    (".tgz", "tar"),
+    (".tar.gz", "tar"),
+    (".tbz2", "tar"),
+    (".tar.bz2", "tar"),
+    (".txz", "tar"),
+    (".tar.xz", "tar"),
+    (".zip", "zip"),
+    (".rar", "rar"),
+    (".gz", "gz"),
+    (".bz2", "bz2"),
+    (".xz", "xz"),
+    (".lzma", "xz"),
+]
+
+CHUNKSIZE = 1024 * 1024
+
+class ExtractLimitError(Exception):
+    """Raised when extraction would exceed given size limit (see extract and decomp_many)."""
+
+class _Budget(object):
+    """Number of bytes extraction may still write (shared by all threads extracting one archive)."""
+
+    def __init__(self, left, filename):
+        import threading
+        self.left = left
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def check(self, size):
+        if size is not None and size > self.left:
+            raise ExtractLimitError("Size limit exceeded while extracting " + self.filename)
+
+    def take(self, size):
+        with self.lock:
+            self.check(size)
+            self.left -= size
+
+def archive_type(filename):
+    """Return archive type ("tar", "zip", "rar", "gz", "bz2", "xz") of given file name or None if unknown."""
+    lname = filename.lower()
+    for ext, kind in ARCHIVE_TYPES:
+        if lname.endswith(ext):
+            return kind
+    return None
+
+def _makedirs(dirname):
+    try:
+        os.makedirs(dirname)
+    except OSError:
+        if not os.path.isdir(dirname):
+            raise
+
+def _member_path(dirname, name):
+    """Join archive member name with (absolute) dirname, refusing names which would escape it."""
+    path = os.path.normpath(os.path.join(dirname, name.lstrip("/")))
+    if path != dirname and not path.startswith(os.path.join(dirname, "")):
+        raise ValueError("Archive member outside of target directory: " + name)
+    return path
+
+def _member_dir(realdir, path):
+    """Create directory path (of a member) and check it really is inside realdir (realpath of the target directory).
+
+    Catches members written through symlinks extracted (or already present) in the target directory.
+    """
+    _makedirs(path)
+    real = os.path.realpath(path)
+    if real != realdir and not real.startswith(os.path.join(realdir, "")):
+        raise ValueError("Archive member outside of target directory: " + path)
+
+def _member_parent(realdir, path):
+    """Create parent directory of member path and check it really is inside realdir (see _member_dir)."""
+    _member_dir(realdir, os.path.dirname(path))
+
+def _write_member(src, path, chunksize, mode=None, mtime=None, budget=None):
+    """Copy file object src to path chunk by chunk and return the number of bytes written.
+
+    budget - optional _Budget charged for every chunk before it is written (ExtractLimitError when it runs out)
+    """
+    import shutil
+    _makedirs(os.path.dirname(path))
+    if os.path.islink(path):
+        os.unlink(path)
+    with open(path, "wb") as dst:
+        if budget is None:
+            shutil.copyfileobj(src, dst, chunksize)
+        else:
+            while True:
+                chunk = src.read(chunksize)
+                if not chunk:
+                    break
+                budget.take(len(chunk))
+                dst.write(chunk)
+        size = dst.tell()
+    if mode:
+        os.chmod(path, mode)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return size
+
+def _extract_tar(filename, dirname, progress, chunksize, budget):
+    import tarfile
+    entries = size = 0
+    realdir = os.path.realpath(dirname)
+    with tarfile.open(filename, "r|*") as tar: # streaming mode: members are read strictly in order
+        for member in tar:
+            path = _member_path(dirname, member.name)
+            if member.isdir():
+                _member_dir(realdir, path) # (path can be dirname itself: "." member of "tar -C dir .")
+            elif member.isfile():
+                if budget:
+                    budget.check(member.size)
+                _member_parent(realdir, path)
+                src = tar.extractfile(member)
+                size += _write_member(src, path, chunksize, member.mode & 0o777, member.mtime, budget)
+            elif member.issym():
+                target = os.path.normpath(os.path.join(os.path.dirname(path), member.linkname))
+                if os.path.isabs(member.linkname) or (target != dirname and not target.startswith(os.path.join(dirname, ""))):
+                    # skipped like tar's safe extraction filters do, the rest of the archive is still extracted
+                    sys.stderr.write("warning: skipping symlink pointing outside of target directory: %s -> %s\n" % (member.name, member.linkname))
+                    continue
+                _member_parent(realdir, path)
+                if os.path.lexists(path):
+                    os.unlink(path)
+                os.symlink(member.linkname, path)
+            elif member.islnk():
+                source = _member_path(dirname, member.linkname)
+                _member_parent(realdir, source)
+                _member_parent(realdir, path)
+                if os.path.lexists(path):
+                    os.unlink(path)
+                os.link(source, path)
+            else:
+                continue # devices and fifos are not supported
+            entries += 1
+            if progress:
+                progress(member.name, member.size)
+    return entries, size
+
+def _extract_zip(filename, dirname, progress, chunksize, threads, budget):
+    import zipfile
+    import threading
+    import time
+    from multiprocessing.pool import ThreadPool
+
+    with zipfile.ZipFile(filename) as zf:
+        infos = zf.infolist()
+    realdir = os.path.realpath(dirname)
+    files = []
+    for info in infos:
+        path = _member_path(dirname, info.filename)
+        if info.filename.endswith("/"):
+            _member_dir(realdir, path)
+        else:
+            files.append((info, path))
+    if budget:
+        budget.check(sum(info.file_size for info, path in files))
+
+    # every worker gets its own ZipFile handle and a similar amount of data to decompress
+    groups = [[] for i in range(max(1, min(threads, len(files))))]
+    sizes = [0] * len(groups)
+    for info, path in sorted(files, key=lambda f: f[0].file_size, reverse=True):
+        i = sizes.index(min(sizes))
+        groups[i].append((info, path))
+        sizes[i] += info.file_size
+
+    lock = threading.Lock()
+
+    def work(group):
+        size = 0
+        with zipfile.ZipFile(filename) as zf:
+            for info, path in group:
+                mode = (info.external_attr >> 16) & 0o777 if info.create_system == 3 else None
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                _member_parent(realdir, path)
+                with zf.open(info) as src:
+                    size += _write_member(src, path, chunksize, mode, mtime, budget)
+                if progress:
+                    with lock:
+                        progress(info.filename, info.file_size)
+        return size
+
+    if len(groups) == 1:
+        sizes = [work(groups[0])]
+    else:
+        pool = ThreadPool(len(groups))
+        try:
+            sizes = pool.map(work, groups)
+        finally:
+            pool.close()
+    return len(infos), sum(sizes)
+
+def _rar_size(filename):
+    """Total unpacked size of rar archive members (from unrar technical listing)."""
+    import re
+    import subprocess
+    listing = subprocess.check_output(["unrar", "lt", os.path.abspath(filename)]).decode("utf-8", "replace")
+    return sum(int(size) for size in re.findall(r"(?m)^\s*Size:\s*(\d+)\s*$", listing))
+
+def _extract_rar(filename, dirname, progress, budget):
+    import subprocess
+    # there is no rar support in the standard library, so we still need unrar here (but no shell and no chdir)
+    if budget:
+        budget.check(_rar_size(filename))
+    argv = ["unrar", "x", "-y", "-o+", os.path.abspath(filename)]
+    started = time.time()
+    proc = subprocess.Popen(argv, cwd=dirname, stdout=subprocess.PIPE)
+    spawn = time.time() - started
+    entries = 0
+    output = 0
+    size = 0
+    try:
+        for line in iter(proc.stdout.readline, b""):
+            output += len(line)
+            line = line.decode("utf-8", "replace").strip()
+            if line.startswith("Extracting ") and line.endswith("OK"):
+                name = line[len("Extracting "):-len("OK")].strip()
+                try:
+                    membersize = os.path.getsize(os.path.join(dirname, name))
+                except OSError:
+                    membersize = 0
+                entries += 1
+                if budget: # (unrar writes the files itself, so the check is after each member, headers were checked above)
+                    budget.take(membersize)
+                size += membersize
+                if progress:
+                    progress(name, membersize)
+    except BaseException:
+        if proc.poll() is None:
+            proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    _trace("run", "unrar", argv, started, spawn=spawn, exitcode=proc.returncode, output=output)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, "unrar")
+    return entries, size
+
+def _extract_single(filename, dirname, kind, progress, chunksize, budget):
+    if kind == "gz":
+        import gzip
+        opener = gzip.open
+    elif kind == "bz2":
+        import bz2
+        opener = bz2.BZ2File
+    else:
+        import lzma
+        opener = lzma.open
+    name = os.path.splitext(os.path.basename(filename))[0]
+    src = opener(filename, "rb")
+    try:
+        size = _write_member(src, os.path.join(dirname, name), chunksize, budget=budget)
+    finally:
+        src.close()
+    if progress:
+        progress(name, size)
+    return 1, size
+
+def extract(filename, dirname, progress=None, threads=4, chunksize=CHUNKSIZE, limit=None):
+    """Extract given archive to given directory in-process (without any shell and without changing cwd).
+
+    progress - optional function called as progress(membername, membersize) after each extracted member
+    threads - number of threads used to extract zip members in parallel
+    chunksize - size of chunks used to copy member data
+    limit - optional maximum number of bytes to write; ExtractLimitError is raised before going over it
+            (member sizes from archive headers are checked first, then every chunk is counted while copying)
+    Returns a tuple (number of entries, number of bytes extracted).
+    Raises ValueError for unknown archive types.
+
+    Examples:
+    extract("foo.tar.gz", "foo")
+    extract("foo.zip", "/tmp/foo", progress=lambda name, size: sys.stdout.write(name + "\\n"))
+    """
+    kind = archive_type(filename)
+    if not kind:
+        raise ValueError("Unknown archive type: " + filename)
+    dirname = os.path.abspath(dirname)
+    _makedirs(dirname)
+    budget = None if limit is None else _Budget(limit, filename)
+    if kind == "tar":
+        return _extract_tar(filename, dirname, progress, chunksize, budget)
+    elif kind == "zip":
+        return _extract_zip(filename, dirname, progress, chunksize, threads, budget)
+    elif kind == "rar":
+        return _extract_rar(filename, dirname, progress, budget)
+    else:
+        return _extract_single(filename, dirname, kind, progress, chunksize, budget)
 
-def decomp(filename, dirname=None):
-    """Decompresses given file to given directory (or to filename.dir directory by default)"""
+def decomp(filename, dirname=None, progress=None):
+    """Decompresses given file to given directory (or to filename.dir directory by default)
+
+    Returns a tuple (number of entries, number of bytes) - see extract
+    """
 
     if not dirname:
         dirname = filename + ".dir"
-    shell('mkdir "' + dirname + '"')
-    os.chdir(dirname)
-    if filename.endswith(".tar"):
-        shell('tar -xvf "../' + filename + '"')
-    elif filename.endswith(".tgz"):
-        shell('tar -xzvf "../' + filename + '"')
-    elif filename.endswith(".tar.gz"):
-        shell('tar -xzvf "../' + filename + '"')
-    elif filename.endswith(".tar.bz2"):
-        shell('tar -xjvf "../' + filename + '"')
-    elif filename.endswith(".zip"):
-        shell('unzip "../' + filename + '"')
-    elif filename.endswith(".rar"):
-        shell('unrar x "../' + filename + '"')        
-    elif True:
-        print "Unknown archive type"
-    os.chdir("..")
-
-
-def diff(filename1, filename2, filename3=None):
+    if not archive_type(filename):
+        print("Unknown archive type")
+        return None
+    result = extract(filename, dirname, progress)
+    try:
+        dirs_visit(dirname)
+    except (IOError, OSError):
+        pass
+    return result
+
+
+def _archive_rawfile(filename):
+    """Open (decompressed) stream of given archive file; seeking in plain tar is cheap, in compressed ones it's not."""
+    lname = filename.lower()
+    if lname.endswith((".tgz", ".gz")):
+        import gzip
+        return gzip.open(filename, "rb")
+    elif lname.endswith((".tbz2", ".bz2")):
+        import bz2
+        return bz2.BZ2File(filename, "rb")
+    elif lname.endswith((".txz", ".xz", ".lzma")):
+        import lzma
+        return lzma.open(filename, "rb")
+    return open(filename, "rb")
+
+def archive_index(filename):
+    """Return list of archive members: tuples (name, size, type, offset, linkname).
+
+    type is one of: "file", "dir", "sym", "link", "other"; offset is the position of member data
+    (in the decompressed stream for tar archives, local header offset for zip archives).
+    The index is cached (keyed by archive path, size and mtime), so the archive is scanned only once.
+    """
+    kind = archive_type(filename)
+    if not kind:
+        raise ValueError("Unknown archive type: " + filename)
+    path = os.path.abspath(filename)
+    st = os.stat(path)
+    cachename = _cachefile("archive", path)
+    cached = _cache_load(cachename)
+    if cached and tuple(cached[:2]) == (st.st_size, st.st_mtime):
+        return cached[2]
+    members = []
+    if kind == "tar":
+        import tarfile
+        with tarfile.open(path, "r|*") as tar:
+            for m in tar:
+                mtype = "file" if m.isfile() else "dir" if m.isdir() else "sym" if m.issym() else "link" if m.islnk() else "other"
+                members.append((m.name, m.size, mtype, m.offset_data, m.linkname))
+    elif kind == "zip":
+        import zipfile
+        with zipfile.ZipFile(path) as zf:
+            for i in zf.infolist():
+                members.append((i.filename, i.file_size, "dir" if i.filename.endswith("/") else "file", i.header_offset, ""))
+    elif kind == "rar":
+        import subprocess
+        for name in subprocess.check_output(["unrar", "lb", path]).decode("utf-8", "replace").splitlines():
+            members.append((name, None, "file", None, ""))
+    else:
+        members.append((os.path.splitext(os.path.basename(path))[0], None, "file", 0, ""))
+    _cache_save(cachename, (st.st_size, st.st_mtime, members))
+    return members
+
+def archive_list(filename):
+    """Return names of all members of given archive (see archive_index)."""
+    return [m[0] for m in archive_index(filename)]
+
+def archive_stream(filename, member, chunksize=CHUNKSIZE):
+    """Yield content of one archive member in chunks, without extracting anything else.
+
+    For plain tar archives we seek straight to the member data (using the index); compressed tar archives
+    are decompressed only up to the end of the member. Symbolic and hard links in tar archives are followed.
+    Raises KeyError if there is no such member.
+    """
+    kind = archive_type(filename)
+    # names are normalized the same way as link targets (so "./src/f" from "tar -C dir ." is found as "src/f")
+    members = dict((os.path.normpath(m[0]), m) for m in archive_index(filename))
+    for i in range(32): # follow links (but not forever)
+        name, size, mtype, offset, linkname = members[os.path.normpath(member)]
+        if mtype == "sym":
+            member = os.path.normpath(os.path.join(os.path.dirname(name), linkname))
+        elif mtype == "link":
+            member = linkname
+        else:
+            break
+    if mtype != "file":
+        raise KeyError(member + " is not a regular file")
+    if kind == "zip":
+        import zipfile
+        with zipfile.ZipFile(filename) as zf:
+            with zf.open(name) as src:
+                for chunk in iter(lambda: src.read(chunksize), b""):
+                    yield chunk
+    elif kind == "rar":
+        import subprocess
+        argv = ["unrar", "p", "-inul", os.path.abspath(filename), name]
+        started = time.time()
+        proc = subprocess.Popen(argv, stdout=subprocess.PIPE)
+        try:
+            for chunk in iter(lambda: proc.stdout.read(chunksize), b""):
+                yield chunk
+        finally:
+            proc.stdout.close()
+            proc.wait()
+            _trace("run", "unrar", argv, started, exitcode=proc.returncode)
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, "unrar")
+    else:
+        with _archive_rawfile(filename) as src:
+            src.seek(offset)
+            left = size
+            while left is None or left > 0:
+                chunk = src.read(chunksize if left is None else min(chunksize, left))
+                if not chunk:
+                    break
+                if left is not None:
+                    left -= len(chunk)
+                yield chunk
+
+def archive_extract(filename, member, dirname=None):
+    """Extract one member of given archive to given directory (filename.dir by default); return path of the new file."""
+    dirname = os.path.abspath(dirname or filename + ".dir")
+    path = _member_path(dirname, member)
+    chunks = archive_stream(filename, member)
+    try:
+        first = next(chunks, b"") # (looks the member up: a missing one raises KeyError before anything is created)
+        _member_parent(os.path.realpath(dirname), path)
+        if os.path.islink(path):
+            os.unlink(path)
+        with open(path, "wb") as dst:
+            try:
+                dst.write(first)
+                for chunk in chunks:
+                    dst.write(chunk)
+            except BaseException:
+                dst.close()
+                os.unlink(path) # (no half written files)
+                raise
+    finally:
+        chunks.close()
+    return path
+
+def _decomp_tree(filename, dirname, depth, maxdepth, limit):
+    """Extract archive and (if depth < maxdepth) archives found in extracted files; return (entries, bytes, nested archives)."""
+    entries, size = extract(filename, dirname, limit=limit)
+    nested = []
+    if depth < maxdepth:
+        for dirpath, dirnames, names in os.walk(dirname):
+            for name in sorted(names):
+                path = os.path.join(dirpath, name)
+                if archive_type(path) and not os.path.islink(path):
+                    e, b, n = _decomp_tree(path, path + ".dir", depth + 1, maxdepth, None if limit is None else limit - size)
+                    entries, size = entries + e, size + b
+                    nested += [path] + n
+            dirnames[:] = [d for d in dirnames if not (archive_type(d[:-len(".dir")]) and d.endswith(".dir"))]
+    return entries, size, nested
+
+def _decomp_job(args):
+    filename, recursive, maxdepth, maxsize = args
+    start = time.time()
+    summary = {"archive": filename, "dir": filename + ".dir", "entries": 0, "bytes": 0, "nested": [], "error": None}
+    try:
+        summary["entries"], summary["bytes"], summary["nested"] = _decomp_tree(
+            filename, summary["dir"], 0, maxdepth if recursive else 0, maxsize)
+    except Exception as e:
+        summary["error"] = "%s: %s" % (type(e).__name__, e)
+    summary["seconds"] = time.time() - start
+    return summary
+
+def decomp_many(paths, jobs=None, recursive=False, maxdepth=3, maxsize=None):
+    """Decompress many archives (or all archives in given directories) in parallel, each to its filename.dir.
+
+    jobs - number of worker processes (default: number of cpus); the biggest archives are started first
+    recursive - extract also archives found inside extracted files (to their own filename.dir)
+    maxdepth - how deep to recurse into nested archives
+    maxsize - bytes; extraction of an archive (with nested ones) stops with an error before writing more than that
+    Returns list of summaries (dicts with keys: archive, dir, entries, bytes, seconds, nested, error)
+    in the order in which the archives finished.
+    """
+    from multiprocessing import Pool, cpu_count
+    archives = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, names in os.walk(path):
+                archives += [os.path.join(dirpath, n) for n in names if archive_type(n)]
+        else:
+            archives.append(path)
+    archives.sort(key=lambda a: os.path.getsize(a) if os.path.isfile(a) else 0, reverse=True)
+    tasks = [(a, recursive, maxdepth, maxsize) for a in archives]
+    jobs = min(jobs or cpu_count(), len(tasks))
+    if jobs <= 1:
+        return [_decomp_job(t) for t in tasks]
+    pool = Pool(jobs)
+    try:
+        return list(pool.imap_unordered(_decomp_job, tasks, 1))
+    finally:
+        pool.close()
+        pool.join()
+
+def _print_decomp_summaries(summaries):
+    print("%10s %14s %9s  %s" % ("ENTRIES", "BYTES", "TIME[s]", "ARCHIVE"))
+    for s in summaries:
+        print("%10d %14d %9.2f  %s%s" % (s["entries"], s["bytes"], s["seconds"], s["archive"],
+                                         " (" + s["error"] + ")" if s["error"] else ""))
+
+DIFF_GUI_MAXSIZE = 64 * 1024 * 1024 # bytes; bigger files are diffed in text mode instead of gvimdiff
+DIFF_MAXCOST = 4000 # max edit distance searched in regions without unique lines (more is reported as one change)
+
+def files_identical(filename1, filename2, chunksize=CHUNKSIZE):
+    """Return True if given files have the same content (sizes are compared first, then data chunk by chunk)."""
+    if os.path.getsize(filename1) != os.path.getsize(filename2):
+        return False
+    with open(filename1, "rb") as f1:
+        with open(filename2, "rb") as f2:
+            while True:
+                chunk = f1.read(chunksize)
+                if chunk != f2.read(chunksize):
+                    return False
+                if not chunk:
+                    return True
+
+def _file_lines(filename):
+    """Return list of lines (bytes, with line ends) of given file, read through mmap."""
+    import mmap
+    with open(filename, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return []
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return list(iter(m.readline, b""))
+        finally:
+            m.close()
+
+def _intern_lines(*seqs):
+    """Replace lines with small ints (equal lines get equal ints), so comparing lines is comparing ints."""
+    ids = {}
+    return [[ids.setdefault(line, len(ids)) for line in seq] for seq in seqs]
+
+def _unique_matches(a, b, alo, ahi, blo, bhi):
+    """Return longest increasing sequence of (i, j) pairs of lines unique in both a[alo:ahi] and b[blo:bhi] (patience)."""
+    import bisect
+    import collections
+    counta = collections.Counter(a[alo:ahi])
+    countb = collections.Counter(b[blo:bhi])
+    unique = set([line for line, n in counta.items() if n == 1 and countb.get(line) == 1])
+    if not unique:
+        return []
+    posb = dict((line, j) for j, line in enumerate(b[blo:bhi], blo) if line in unique)
+    tops, topsj, back = [], [], {}
+    for i, line in enumerate(a[alo:ahi], alo):
+        if line not in unique:
+            continue
+        j = posb[line]
+        k = bisect.bisect_left(topsj, j)
+        back[i] = tops[k - 1] if k else None
+        if k == len(tops):
+            tops.append((i, j))
+            topsj.append(j)
+        else:
+            tops[k] = (i, j)
+            topsj[k] = j
+    result = []
+    node = tops[-1]
+    while node is not None:
+        result.append(node)
+        node = back[node[0]]
+    return result[::-1]
+
+def _myers_matches(a, b, alo, ahi, blo, bhi, maxcost):
+    """Return matching (i, j) pairs of shortest edit script (Myers' O(ND) algorithm) or None if it costs more than maxcost."""
+    n, m = ahi - alo, bhi - blo
+    v = {1: 0}
+    trace = []
+    for d in range(min(n + m, maxcost) + 1):
+        trace.append(v.copy())
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                matches = []
+                for d in range(len(trace) - 1, -1, -1):
+                    v = trace[d]
+                    k = x - y
+                    if k == -d or (k != d and v.get(k - 1, -1) < v.get(k + 1, -1)):
+                        prevx = v[k + 1]
+                        prevk = k + 1
+                    else:
+                        prevx = v[k - 1]
+                        prevk = k - 1
+                    prevy = prevx - prevk
+                    while x > prevx and y > prevy:
+                        x -= 1
+                        y -= 1
+                        matches.append((alo + x, blo + y))
+                    x, y = prevx, prevy
+                return matches[::-1]
+    return None
+
+def diff_opcodes(a, b, maxcost=DIFF_MAXCOST):
+    """Compare two sequences of lines and return list of opcodes like difflib.SequenceMatcher.get_opcodes does.
+
+    It's a patience diff: common prefix and suffix are stripped, lines unique in both sequences are used
+    as anchors and regions between anchors are compared recursively; regions without unique lines are
+    compared with Myers' algorithm (up to maxcost edits). Lines are compared as interned ints,
+    so it is fast enough for files with millions of lines (unlike difflib).
+    """
+    a, b = _intern_lines(a, b)
+    runs = [] # matching blocks: (i, j, length)
+    todo = [(0, len(a), 0, len(b))]
+    while todo:
+        alo, ahi, blo, bhi = todo.pop()
+        start = alo
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            alo += 1
+            blo += 1
+        if alo > start:
+            runs.append((start, blo - (alo - start), alo - start))
+        end = ahi
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+        if ahi < end:
+            runs.append((ahi, bhi, end - ahi))
+        if alo == ahi or blo == bhi:
+            continue
+        anchors = _unique_matches(a, b, alo, ahi, blo, bhi)
+        if anchors:
+            runs += [(i, j, 1) for i, j in anchors]
+            bounds = [(alo - 1, blo - 1)] + anchors + [(ahi, bhi)]
+            for (i1, j1), (i2, j2) in zip(bounds, bounds[1:]):
+                if i2 - i1 > 1 or j2 - j1 > 1:
+                    todo.append((i1 + 1, i2, j1 + 1, j2))
+        else:
+            runs += [(i, j, 1) for i, j in _myers_matches(a, b, alo, ahi, blo, bhi, maxcost) or []]
+    runs.sort()
+    opcodes = []
+    i = j = 0
+    for mi, mj, size in runs + [(len(a), len(b), 0)]:
+        if i < mi or j < mj:
+            tag = "replace" if i < mi and j < mj else "delete" if i < mi else "insert"
+            opcodes.append((tag, i, mi, j, mj))
+        if size:
+            if opcodes and opcodes[-1][0] == "equal":
+                opcodes[-1] = ("equal", opcodes[-1][1], mi + size, opcodes[-1][3], mj + size)
+            else:
+                opcodes.append(("equal", mi, mi + size, mj, mj + size))
+        i, j = mi + size, mj + size
+    return opcodes
+
+def _hunk_range(start, count):
+    if count == 1:
+        return "%d" % (start + 1)
+    return "%d,%d" % (start + 1 if count else start, count)
+
+def _diff_line(prefix, line):
+    if line.endswith(b"\n"):
+        return prefix + line
+    return prefix + line + b"\n\\ No newline at end of file\n"
+
+def unified_diff(filename1, filename2, n=3):
+    """Yield lines (bytes) of unified diff of given files (like diff -u) computed in-process (see diff_opcodes)."""
+    a, b = _file_lines(filename1), _file_lines(filename2)
+    opcodes = diff_opcodes(a, b)
+    changes = [i for i, op in enumerate(opcodes) if op[0] != "equal"]
+    if not changes:
+        return
+    yield _bytes("--- %s\n+++ %s\n" % (filename1, filename2))
+    groups = []
+    for i in changes: # group changes which are closer than 2 * n equal lines
+        if groups and opcodes[i][1] - opcodes[groups[-1][-1]][2] <= 2 * n:
+            groups[-1].append(i)
+        else:
+            groups.append([i])
+    for group in groups:
+        first, last = opcodes[group[0]], opcodes[group[-1]]
+        i1, j1 = max(0, first[1] - n), max(0, first[3] - n)
+        i2, j2 = min(len(a), last[2] + n), min(len(b), last[4] + n)
+        yield _bytes("@@ -%s +%s @@\n" % (_hunk_range(i1, i2 - i1), _hunk_range(j1, j2 - j1)))
+        for tag, ai1, ai2, bj1, bj2 in opcodes[group[0] - 1 if group[0] else 0:group[-1] + 2]:
+            if tag == "equal":
+                lo, hi = max(ai1, i1), min(ai2, i2)
+                for line in a[lo:hi]:
+                    yield _diff_line(b" ", line)
+                continue
+            for line in a[ai1:ai2]:
+                yield _diff_line(b"-", line)
+            for line in b[bj1:bj2]:
+                yield _diff_line(b"+", line)
+
+def diff3(filename1, filename2, filename3):
+    """Yield lines (bytes) of three way diff (like GNU diff3 MINE OLDER YOURS: filename2 is the common ancestor)."""
+    mine, base, yours = _file_lines(filename1), _file_lines(filename2), _file_lines(filename3)
+    changes = []
+    for side, other in ((1, mine), (3, yours)):
+        changes += [(i1, i2, side, j1, j2) for tag, i1, i2, j1, j2 in diff_opcodes(base, other) if tag != "equal"]
+    changes.sort()
+    chunks = []
+    hi = None
+    for change in changes: # merge changes of both sides which overlap or just touch in base (like diff3 does)
+        if chunks and change[0] <= hi:
+            chunks[-1].append(change)
+            hi = max(hi, change[1])
+        else:
+            chunks.append([change])
+            hi = change[1]
+    offsets = {1: 0, 3: 0} # line offset of mine/yours against base after the last processed change
+    for chunk in chunks:
+        lo, hi = min(c[0] for c in chunk), max(c[1] for c in chunk)
+        ranges = {2: (lo, hi)}
+        for side in (1, 3):
+            own = [c for c in chunk if c[2] == side]
+            if own:
+                ranges[side] = (own[0][3] - (own[0][0] - lo), own[-1][4] + (hi - own[-1][1]))
+                offsets[side] = own[-1][4] - own[-1][1]
+            else:
+                ranges[side] = (lo + offsets[side], hi + offsets[side])
+        texts = {1: mine[slice(*ranges[1])], 2: base[slice(*ranges[2])], 3: yours[slice(*ranges[3])]}
+        if texts[1] == texts[3]:
+            header = "====2"
+        elif texts[1] == texts[2]:
+            header = "====3"
+        elif texts[3] == texts[2]:
+            header = "====1"
+        else:
+            header = "===="
+        yield _bytes(header + "\n")
+        order = (1, 3, 2) if header == "====2" else (1, 2, 3) # (the odd file goes last, like in diff3)
+        for i, side in enumerate(order):
+            start, end = ranges[side]
+            if start == end:
+                yield _bytes("%d:%da\n" % (side, start))
+                continue
+            yield _bytes("%d:%sc\n" % (side, "%d" % end if end - start == 1 else "%d,%d" % (start + 1, end)))
+            if any(texts[side] == texts[later] for later in order[i + 1:]):
+                continue # the same text is printed for later file (like diff3 does)
+            for line in texts[side]:
+                yield _diff_line(b"  ", line)
+
+def diff(filename1, filename2, filename3=None, text=False):
+    """Run the best text editor in diff mode (or print the differences if text is True or files are too big).
+
+    Identical files are detected before anything is started. Returns 0 if files are identical, 1 otherwise.
+    """
+    filenames = [f for f in (filename1, filename2, filename3) if f]
+    if all(files_identical(filename1, f) for f in filenames[1:]):
+        print("Files are identical")
+        return 0
+    if text or sum(os.path.getsize(f) for f in filenames) > DIFF_GUI_MAXSIZE:
+        out = getattr(sys.stdout, "buffer", sys.stdout)
+        lines = diff3(*filenames) if filename3 else unified_diff(filename1, filename2)
+        for line in lines:
+            out.write(line)
+        out.flush()
+        return 1
     addfilenames = [filename2]
     if filename3:
         addfilenames.append(filename3)
@@ -195,12 +2221,234 @@ def diff(filename1, filename2, filename3=None):
         vimservername="DIFF",
         addfilenames=addfilenames
     )
+    return 1
 
     #TODO: activate diff window if under qtile
  
 
+DIRS_MAXRANK = 10000 # when ranks of all directories in the frecency index add up to more, they are aged
+DIRS_JOURNAL_MAX = 64 * 1024 # bytes; visits journal is folded into the frecency index by queries or when it gets bigger
+
+def _dirs_file():
+    return os.path.join(_cachedir(), "dirs-py%d%d" % sys.version_info[:2]) # (no hashlib, see _parse_args)
+
+def _dirs_journal():
+    return os.path.join(_cachedir(), "dirs-journal-py%d%d" % sys.version_info[:2])
+
+def _array(typecode, data=b""):
+    import array
+    a = array.array(typecode)
+    if data:
+        (a.frombytes if hasattr(a, "frombytes") else a.fromstring)(data)
+    return a
+
+def _array_bytes(a):
+    return a.tobytes() if hasattr(a, "tobytes") else a.tostring()
+
+def _dirs_build(entries):
+    """Make frecency index from list of (path, rank, access time).
+
+    The index is compact and quick to load: all paths in one string, all lowercased basenames in another one
+    (the one searched by queries), and offsets, ranks and times in arrays.
+    """
+    index = {"total": 0.0, "paths": "", "names": "", "poffsets": _array("l"), "noffsets": _array("l"),
+             "ranks": _array("d"), "times": _array("d")}
+    paths, names = [], []
+    ppos = npos = 0
+    for path, rank, atime in entries:
+        name = (os.path.basename(path) or path).lower()
+        index["poffsets"].append(ppos)
+        index["noffsets"].append(npos)
+        index["ranks"].append(rank)
+        index["times"].append(atime)
+        index["total"] += rank
+        paths.append(path)
+        names.append(name)
+        ppos += len(path) + 1
+        npos += len(name) + 1
+    index["paths"] = "".join(p + "\n" for p in paths)
+    index["names"] = "".join(n + "\n" for n in names)
+    return index
+
+def _dirs_entries(index):
+    paths = index["paths"].split("\n")[:-1]
+    return list(zip(paths, index["ranks"], index["times"]))
+
+def _dirs_load():
+    data = _cache_load(_dirs_file())
+    if not data:
+        return _dirs_build([])
+    total, paths, names, poffsets, noffsets, ranks, times = data
+    return {"total": total, "paths": paths, "names": names, "poffsets": _array("l", poffsets),
+            "noffsets": _array("l", noffsets), "ranks": _array("d", ranks), "times": _array("d", times)}
+
+def _dirs_save(index):
+    _cache_save(_dirs_file(), (index["total"], index["paths"], index["names"], _array_bytes(index["poffsets"]),
+                               _array_bytes(index["noffsets"]), _array_bytes(index["ranks"]), _array_bytes(index["times"])))
+
+def _dirs_find(index, path):
+    """Position of given path in the index or None."""
+    import bisect
+    paths = index["paths"]
+    if paths.startswith(path + "\n"):
+        pos = 0
+    else:
+        pos = paths.find("\n" + path + "\n")
+        if pos < 0:
+            return None
+        pos += 1
+    return bisect.bisect_right(index["poffsets"], pos) - 1
+
+def dirs_visit(*dirnames):
+    """Record a visit of given directories in the frecency index (used by edit, fmgr and decomp; see dirs_jump).
+
+    Visits are just appended to a small journal (one write, no index loading, so edit doesn't wait for it);
+    they get into the index when it is queried next time (see _dirs_fold).
+    """
+    import fcntl
+    now = time.time()
+    paths = [os.path.abspath(d) for d in dirnames]
+    lines = "".join("%r\t%s\n" % (now, p) for p in paths if "\n" not in p)
+    if not lines:
+        return
+    fd = os.open(_dirs_journal(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH) # (appending visits don't block each other, only folding blocks them)
+        os.write(fd, lines if isinstance(lines, bytes) else lines.encode("utf-8", "surrogateescape"))
+        size = os.fstat(fd).st_size
+    finally:
+        os.close(fd)
+    if size > DIRS_JOURNAL_MAX:
+        _dirs_fold()
+
+def _dirs_fold():
+    """Fold visits from the journal into the frecency index and return the index.
+
+    It is done under an exclusive lock of the journal, so concurrent visits are never lost.
+    """
+    import fcntl
+    try:
+        fd = os.open(_dirs_journal(), os.O_RDWR)
+    except OSError:
+        return _dirs_load()
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        chunks = []
+        for chunk in iter(lambda: os.read(fd, CHUNKSIZE), b""):
+            chunks.append(chunk)
+        index = _dirs_load()
+        if chunks:
+            data = b"".join(chunks)
+            if bytes is not str:
+                data = data.decode("utf-8", "surrogateescape")
+            visits = []
+            for line in data.split("\n"):
+                atime, tab, path = line.partition("\t")
+                if tab:
+                    visits.append((float(atime), path))
+            index = _dirs_add(index, visits)
+            _dirs_save(index)
+            os.ftruncate(fd, 0)
+    finally:
+        os.close(fd)
+    return index
+
+def _dirs_add(index, visits):
+    """Add given (time, path) visits to the frecency index and return it (a new one if it was aged).
+
+    Every visit adds 1 to the directory rank; when all ranks add up to more than DIRS_MAXRANK,
+    all ranks are scaled down and directories with rank below 1 (or which don't exist anymore) are dropped.
+    """
+    for now, path in visits:
+        i = _dirs_find(index, path)
+        if i is None:
+            name = (os.path.basename(path) or path).lower()
+            index["poffsets"].append(len(index["paths"]))
+            index["noffsets"].append(len(index["names"]))
+            index["ranks"].append(1.0)
+            index["times"].append(now)
+            index["paths"] += path + "\n"
+            index["names"] += name + "\n"
+        else:
+            index["ranks"][i] += 1
+            index["times"][i] = max(now, index["times"][i])
+        index["total"] += 1
+    if index["total"] > DIRS_MAXRANK:
+        factor = 0.9 * DIRS_MAXRANK / index["total"]
+        index = _dirs_build([(p, r * factor, t) for p, r, t in _dirs_entries(index) if r * factor >= 1 and os.path.isdir(p)])
+    return index
+
+def _frecency(rank, atime, now):
+    age = now - atime
+    if age < 3600:
+        return rank * 4
+    if age < 86400:
+        return rank * 2
+    if age < 7 * 86400:
+        return rank / 2
+    return rank / 4
+
+def dirs_query(query, limit=10):
+    """Return up to limit directories from the frecency index matching given query, best first.
+
+    The query is one or more words (case insensitive). The last word has to be found in the directory name,
+    the others anywhere in the path (in given order). If nothing matches, the last word is matched fuzzily
+    (its characters in order, like "prj" matches "projects").
+    """
+    import bisect
+    import re
+    index = _dirs_fold()
+    words = query.lower().split()
+    if not words:
+        return []
+    names, noffsets = index["names"], index["noffsets"]
+    for pattern in [re.escape(words[-1]), "[^\n]*?".join(re.escape(c) for c in words[-1])]:
+        regex = re.compile(pattern)
+        candidates = []
+        pos = 0
+        while True:
+            m = regex.search(names, pos)
+            if not m:
+                break
+            candidates.append(bisect.bisect_right(noffsets, m.start()) - 1)
+            pos = names.find("\n", m.start()) + 1
+        if candidates:
+            break
+    now = time.time()
+    paths, poffsets = index["paths"], index["poffsets"]
+    found = []
+    for i in candidates:
+        path = paths[poffsets[i]:paths.find("\n", poffsets[i])]
+        lowpath, pos = path.lower(), 0
+        for word in words[:-1]:
+            pos = lowpath.find(word, pos)
+            if pos < 0:
+                break
+            pos += len(word)
+        if pos >= 0:
+            found.append((_frecency(index["ranks"][i], index["times"][i], now), path))
+    found.sort(reverse=True)
+    return [path for score, path in found[:limit]]
+
+def dirs_jump(query):
+    """Return the best existing directory from the frecency index matching given query (see dirs_query) or None."""
+    for path in dirs_query(query):
+        if os.path.isdir(path):
+            return path
+    return None
+
 def fmgr(dirname):
-    """Run the best file manager (or open a directory in an existing instance)."""
+    """Run the best file manager (or open a directory in an existing instance).
+
+    dirname - a directory, a file (its directory is opened) or a query for the frecency index of visited
+              directories (see dirs_jump), like "ml cmd" or just "cmd"
+    """
+    if not os.path.exists(dirname):
+        path = dirs_jump(dirname)
+        if path is None:
+            print("No directory matches: " + dirname)
+            return
+        dirname = path
     if os.path.isfile(dirname):
         dirname = os.path.dirname(dirname)
     edit(dirname, vimservername="FILEMANAGER")
@@ -208,16 +2456,380 @@ def fmgr(dirname):
     #TODO: activate fmgr window if under qtile
 
 
+def _cachedir():
+    """Per user directory for persistent caches and indexes (~/.cache/ml.cmd)."""
+    cachedir = os.path.join(os.environ.get("XDG_CACHE_HOME") or exp("~/.cache"), "ml.cmd")
+    _makedirs(cachedir)
+    return cachedir
+
+def _cachefile(kind, key):
+    """Name of the cache file for given kind of data and key (like a directory path)."""
+    import hashlib
+    return os.path.join(_cachedir(), "%s-%s-py%d%d" % (kind, hashlib.md5(_bytes(key)).hexdigest(), sys.version_info[0], sys.version_info[1]))
+
+def _cache_load(filename, default=None):
+    import marshal
+    try:
+        with open(filename, "rb") as f:
+            return marshal.load(f)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return default
+
+def _cache_save(filename, data):
+    """Save data atomically (readers see either old or new content), so concurrent users never see a torn file."""
+    import marshal
+    import tempfile
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            marshal.dump(data, f)
+        os.rename(tmpname, filename)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+def _scandir(dirname):
+    """Yield (name, isdir) for entries of given directory (using os.scandir when available, so without stat calls).
+
+    Symlinks to directories are not reported as directories, so walks can't loop through them.
+    """
+    if hasattr(os, "scandir"):
+        for entry in os.scandir(dirname):
+            try:
+                yield entry.name, entry.is_dir(follow_symlinks=False)
+            except OSError:
+                continue
+    else:
+        for name in os.listdir(dirname):
+            path = os.path.join(dirname, name)
+            yield name, os.path.isdir(path) and not os.path.islink(path)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif")
+FEHBACK_SCREENS = 2
+FEHBACK_RESOLUTIONS = [(1920, 1080), (1920, 1080)] # one per screen (in feh order); wallpapers are pre-scaled to these
+WALLPAPER_CACHE_MAX = 256 * 1024 * 1024 # bytes; least recently used pre-scaled wallpapers are removed above that
+FEHBACK_HISTORY = 100 # recently used images are not picked again (unless there are too few images)
+FEHBACK_RESCAN = 60 # seconds; the catalog is trusted without checking directories for that long
+
+def _image_catalog(dirname):
+    """Load (and update if needed) the catalog of images in given directory tree.
+
+    The catalog remembers mtime, images and subdirectories of every directory, so a directory
+    is only listed again when its mtime changes. Returns the catalog dict; "images" is a flat list.
+    """
+    root = os.path.abspath(dirname)
+    cachename = _cachefile("fehback", root)
+    catalog = _cache_load(cachename) or {"dirs": {}, "images": [], "checked": 0}
+    if time.time() - catalog["checked"] < FEHBACK_RESCAN:
+        return catalog
+
+    olddirs, dirs = catalog["dirs"], {}
+    changed = False
+    todo = [root]
+    while todo:
+        path = todo.pop()
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            changed = True
+            continue
+        if path in olddirs and olddirs[path][0] == mtime:
+            dirs[path] = olddirs[path]
+        else:
+            changed = True
+            images, subdirs = [], []
+            for name, isdir in _scandir(path):
+                if isdir:
+                    subdirs.append(name)
+                elif name.lower().endswith(IMAGE_EXTENSIONS):
+                    images.append(name)
+            dirs[path] = (mtime, images, subdirs)
+        todo.extend(os.path.join(path, d) for d in dirs[path][2])
+    if changed or len(dirs) != len(olddirs):
+        catalog["images"] = [os.path.join(d, f) for d in sorted(dirs) for f in dirs[d][1]]
+    catalog["dirs"] = dirs
+    catalog["checked"] = time.time()
+    _cache_save(cachename, catalog)
+    return catalog
+
+def _fehback_sample(images, history, count):
+    """Pick count random images, avoiding the recent ones from history (as many of them as images allow)."""
+    import random
+    if len(images) < count:
+        return [random.choice(images) for i in range(count)]
+    keep = min(FEHBACK_HISTORY, len(images) - count)
+    recent = set(history[-keep:]) if keep else set()
+    if (len(images) - keep) * 2 < len(images): # mostly recent images: filter them out (the catalog is small then)
+        return random.sample([f for f in images if f not in recent], count)
+    # random indexes into the flat list until we have count new images (less than two tries per image on average)
+    picked = []
+    while len(picked) < count:
+        f = images[random.randrange(len(images))]
+        if f not in recent:
+            recent.add(f)
+            picked.append(f)
+    return picked
+
+def fehback_pick(dirname, count=FEHBACK_SCREENS):
+    """Pick count random images from given directory tree (recursively), avoiding recently picked ones.
+
+    The next pick is chosen ahead of time (see fehback_upcoming), so its wallpapers can be pre-scaled before
+    they are needed. The rotation is kept in its own small file, so picking doesn't rewrite the whole catalog.
+    Returns a list of paths (with repetitions if there are less than count images, empty if there are none).
+    """
+    images = _image_catalog(dirname)["images"]
+    if not images:
+        return []
+    rotationname = _cachefile("fehback-rotation", os.path.abspath(dirname))
+    rotation = _cache_load(rotationname) or {"history": [], "upcoming": []}
+    picked = [f for f in rotation["upcoming"] if os.path.exists(f)][:count]
+    if len(picked) < count:
+        picked += _fehback_sample(images, rotation["history"] + picked, count - len(picked))
+    rotation["history"] = (rotation["history"] + picked)[-FEHBACK_HISTORY:]
+    rotation["upcoming"] = _fehback_sample(images, rotation["history"], count)
+    _cache_save(rotationname, rotation)
+    return picked
+
+def fehback_upcoming(dirname):
+    """Return images which the next fehback_pick for given directory tree is going to pick."""
+    rotation = _cache_load(_cachefile("fehback-rotation", os.path.abspath(dirname))) or {"upcoming": []}
+    return rotation["upcoming"]
+
+def _wallpaper_file(filename, size):
+    """Name of the pre-scaled copy of given image for given (width, height) (it changes when the image changes)."""
+    import hashlib
+    st = os.stat(filename)
+    key = "%s\0%r\0%d" % (os.path.abspath(filename), st.st_mtime, st.st_size)
+    wpdir = os.path.join(_cachedir(), "wallpapers")
+    _makedirs(wpdir)
+    return os.path.join(wpdir, "%s-%dx%d.jpg" % (hashlib.md5(_bytes(key)).hexdigest(), size[0], size[1]))
+
+_wallpaper_scaler = None # "pil", "convert" or "" (none available); found by _wallpaper_scaler_get
+
+def _wallpaper_scaler_get():
+    """Return what can scale images here: "pil", "convert" (ImageMagick) or "" (checked only once per process)."""
+    global _wallpaper_scaler
+    if _wallpaper_scaler is None:
+        try:
+            import PIL.Image
+            _wallpaper_scaler = "pil"
+        except ImportError:
+            path = os.environ.get("PATH", os.defpath).split(os.pathsep)
+            found = any(os.access(os.path.join(d, "convert"), os.X_OK) for d in path if d)
+            _wallpaper_scaler = "convert" if found else ""
+    return _wallpaper_scaler
+
+def _wallpaper_scale(args):
+    """Scale and crop image to fill given size exactly (like feh --bg-fill) and save it as target jpeg.
+
+    Uses PIL if available, ImageMagick otherwise. Returns target, or None if it failed.
+    """
+    filename, size, target = args
+    tmpname = "%s.%d.tmp.jpg" % (target[:-4], os.getpid())
+    try:
+        if _wallpaper_scaler_get() == "convert":
+            import subprocess
+            with open(os.devnull, "wb") as devnull:
+                subprocess.check_call(["convert", filename + "[0]", "-auto-orient", "-resize", "%dx%d^" % size,
+                                       "-gravity", "center", "-extent", "%dx%d" % size, "-quality", "92", tmpname],
+                                      stdout=devnull, stderr=devnull)
+        else:
+            from PIL import Image, ImageOps
+            image = Image.open(filename)
+            image.draft("RGB", size) # (jpeg is decoded already scaled down, which is much faster)
+            if hasattr(ImageOps, "exif_transpose"):
+                image = ImageOps.exif_transpose(image)
+            image = ImageOps.fit(image.convert("RGB"), size, getattr(Image, "LANCZOS", None) or Image.ANTIALIAS)
+            image.save(tmpname, "JPEG", quality=92)
+        os.rename(tmpname, target)
+        return target
+    except Exception:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        return None
+
+def _wallpaper_evict(maxsize):
+    """Remove least recently used pre-scaled wallpapers until they take at most maxsize bytes."""
+    wpdir = os.path.join(_cachedir(), "wallpapers")
+    entries = []
+    for name in os.listdir(wpdir):
+        try:
+            st = os.stat(os.path.join(wpdir, name))
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, os.path.join(wpdir, name)))
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= maxsize:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+def wallpapers(images, jobs=None, scale=True):
+    """Return pre-scaled copies of given (filename, (width, height)) images, scaling those not cached yet in parallel.
+
+    Copies are cached (keyed by path, mtime and size of the image and by the target size) in ~/.cache/ml.cmd/wallpapers,
+    which is kept under WALLPAPER_CACHE_MAX bytes (least recently used copies go first) also while scaling:
+    images are scaled in small batches and scaling stops when copies made by this call alone fill the cache.
+    None is returned for images which can't be scaled (no PIL nor ImageMagick, broken file, no room, ...).
+    jobs - number of worker processes (default: number of cpus)
+    scale - if False, only already cached copies are returned (None for the others)
+    """
+    if not _wallpaper_scaler_get():
+        return [None] * len(images)
+    targets, tasks, queued = [], [], set()
+    for filename, size in images:
+        try:
+            target = _wallpaper_file(filename, size)
+        except OSError:
+            targets.append(None)
+            continue
+        targets.append(target)
+        if os.path.exists(target):
+            os.utime(target, None) # (it is the most recently used one now)
+        elif scale and target not in queued:
+            queued.add(target)
+            tasks.append((filename, size, target))
+    if tasks:
+        from multiprocessing import Pool, cpu_count
+        jobs = min(jobs or cpu_count(), len(tasks))
+        pool = Pool(jobs) if jobs > 1 else None
+        batch = jobs * 4
+        added = 0
+        try:
+            for i in range(0, len(tasks), batch):
+                if pool:
+                    done = pool.map(_wallpaper_scale, tasks[i:i + batch], 1)
+                else:
+                    done = [_wallpaper_scale(t) for t in tasks[i:i + batch]]
+                added += sum(os.path.getsize(t) for t in done if t)
+                _wallpaper_evict(WALLPAPER_CACHE_MAX)
+                if added >= WALLPAPER_CACHE_MAX:
+                    break # more copies would only push out the ones made just now
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+    return [t if t and os.path.exists(t) else None for t in targets]
+
+def fehback_prescale(dirname, jobs=None):
+    """Pre-scale images from given directory tree for all screens (see wallpapers), as many as fit in WALLPAPER_CACHE_MAX.
+
+    fehback itself pre-scales its next pick (see fehback_upcoming), so this is only needed to fill the cache up front.
+    Returns the number of images which failed (or didn't fit).
+    """
+    sizes = sorted(set(FEHBACK_RESOLUTIONS))
+    images = [(f, size) for f in _image_catalog(dirname)["images"] for size in sizes]
+    return len([t for t in wallpapers(images, jobs) if t is None])
+
 def fehback(dirname):
-    filenames = [f for f in os.listdir(dirname) if f[-3:] == "jpg"]
-    filenames = random.sample(filenames, 2)
-    filenames = [os.path.join(dirname, f) for f in filenames]
-    run("feh", "--bg-fill", *filenames)
+    """Set random background images (from given directory tree) for all screens (using the "feh" app).
+
+    feh gets copies pre-scaled to FEHBACK_RESOLUTIONS (see wallpapers), so it doesn't decode and scale
+    full size photos every time. Nothing is scaled before feh starts: copies of this pick were prepared
+    by the previous fehback (original images are used if they are not there). After feh starts,
+    copies of the upcoming pick are prepared for the next switch.
+    """
+    filenames = fehback_pick(dirname)
+    if not filenames:
+        print("No images found")
+        return
+    sizes = [FEHBACK_RESOLUTIONS[i % len(FEHBACK_RESOLUTIONS)] for i in range(len(filenames))]
+    scaled = wallpapers(list(zip(filenames, sizes)), scale=False)
+    run("feh", "--bg-fill", *[s or f for s, f in zip(scaled, filenames)])
+    wallpapers(list(zip(fehback_upcoming(dirname), sizes)))
+
+USRCMD_FILE = "~/.usrcmd.py"
+USRCMD_DIR = "~/.usrcmd.d" # more user commands: every *.py file there is a module with some functions
+
+_usrmods = {} # path -> (mtime, size, module)
+
+def _usrmod(path, name):
+    """Return user module loaded from given path; it is executed again only if the file has changed.
+
+    Compiled code is cached on disk (keyed by path, mtime and size), so even a new process doesn't compile it again.
+    """
+    import types
+    st = os.stat(path)
+    key = (st.st_mtime, st.st_size)
+    if path in _usrmods and _usrmods[path][:2] == key:
+        return _usrmods[path][2]
+    cachename = _cachefile("usrcmd", path)
+    cached = _cache_load(cachename)
+    if cached and tuple(cached[:2]) == key:
+        code = cached[2]
+    else:
+        with open(path, "rb") as f:
+            code = compile(f.read(), path, "exec")
+        _cache_save(cachename, (key[0], key[1], code))
+    mod = types.ModuleType(name)
+    mod.__file__ = path
+    exec(code, mod.__dict__) # if it fails, previously loaded version (if any) stays in use
+    sys.modules[name] = mod
+    _usrmods[path] = (key[0], key[1], mod)
+    return mod
+
+def _usrcmd_index(paths):
+    """Return dict: function name -> module path for all top level functions defined in given modules.
+
+    Modules are parsed (not imported) and the index is cached, so only new or changed files are parsed again.
+    Modules which can't be parsed are skipped (until they change). The first module defining a name wins.
+    """
+    import ast
+    cachename = _cachefile("usrcmdindex", exp(USRCMD_DIR))
+    oldindex = _cache_load(cachename, {})
+    index = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if path in oldindex and tuple(oldindex[path][:2]) == (st.st_mtime, st.st_size):
+            index[path] = oldindex[path]
+            continue
+        try:
+            with open(path, "rb") as f:
+                tree = ast.parse(f.read(), path)
+            funcs = [node.name for node in tree.body if isinstance(node, ast.FunctionDef)]
+        except (SyntaxError, ValueError, TypeError, IOError, OSError):
+            funcs = []
+        index[path] = (st.st_mtime, st.st_size, funcs)
+    if index != oldindex:
+        _cache_save(cachename, index)
+    return dict((func, path) for path in reversed(paths) if path in index for func in index[path][2])
+
+def usrcmd_get(cmd):
+    """Return user defined function with given name (from ~/.usrcmd.py or from modules in ~/.usrcmd.d) or None.
+
+    Only functions defined at the top level of these modules count (not imported ones, not other attributes).
+    Modules are indexed without running them and only the module defining the function is loaded
+    (and kept loaded until its file changes).
+    """
+    paths = []
+    if os.path.isfile(exp(USRCMD_FILE)):
+        paths.append(exp(USRCMD_FILE))
+    dirname = exp(USRCMD_DIR)
+    if os.path.isdir(dirname):
+        paths += [os.path.join(dirname, n) for n in sorted(os.listdir(dirname)) if n.endswith(".py")]
+    path = _usrcmd_index(paths).get(cmd)
+    if not path:
+        return None
+    modname = "usrcmd" if path == exp(USRCMD_FILE) else "usrcmd_" + os.path.basename(path)[:-3]
+    func = getattr(_usrmod(path, modname), cmd, None)
+    if callable(func) and getattr(func, "__module__", None) == modname:
+        return func
+    return None
 
 def usrcmd(cmd, *args):
-    """Run given user command (from ~/.usrcmd.py)"""
-    mod = imp.load_source('usrcmd', exp('~/.usrcmd.py'))
-    res = mod.__dict__[cmd](*args);
+    """Run given user command (from ~/.usrcmd.py or ~/.usrcmd.d/*.py)"""
+    from pprint import pprint
+    func = usrcmd_get(cmd)
+    if func is None:
+        raise KeyError(cmd)
+    res = func(*args);
     if res != None:
         pprint(res)
 
@@ -231,56 +2843,608 @@ lo = lopenf
 p = play
 h = hist
 de = decomp
+da = decomp_many
+al = archive_list
+ag = archive_extract
 d = diff
+ud = lambda filename1, filename2, filename3=None: diff(filename1, filename2, filename3, text=True)
 f = fmgr
 fb = fehback
 uc = usrcmd
 
+_ALIASES = {"run": "r", "shell": "s", "term": "t", "edit": "e", "openf": "o", "lopenf": "lo", "play": "p", "hist": "h",
+            "decomp": "de", "decompall": "da", "arclist": "al", "arcget": "ag", "diff": "d", "udiff": "ud", "fmgr": "f", "fehback": "fb", "usrcmd": "uc"}
+
+
+def _daemon_socket():
+    return os.path.join(_rundir(), "ml.cmd.sock")
+
+def _daemon_run(conn, fds):
+    """Executed in forked daemon child: take over client's stdio, cwd and environment and run the command."""
+    import json
+    data = b""
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    request = json.loads(data.decode("utf-8"))
+    for i, fd in enumerate(fds[:3]):
+        os.dup2(fd, i)
+    for fd in fds:
+        os.close(fd)
+    os.chdir(request["cwd"])
+    os.environ.clear()
+    os.environ.update(request["env"])
+    sys.argv = request["argv"]
+    conn.sendall(("%d\n" % os.getpid()).encode())
+    status = 0
+    try:
+        status = main(request["argv"]) or 0
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            status = e.code
+        elif e.code is not None:
+            sys.stderr.write(str(e.code) + "\n")
+            status = 1
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        status = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    conn.sendall(("%d\n" % status).encode())
+    return status
+
+def daemon(sockname=None):
+    """Serve commands from this (warm) process on a unix socket, so they don't pay for interpreter startup.
+
+    Every request is executed in a forked child with client's argv, cwd, environment and stdio
+    (file descriptors are passed through the socket), so commands can't disturb each other or the daemon.
+    Needs python 3 (socket.recvmsg). See client.
+    """
+    global _WARM
+    import socket
+    import struct
+    import signal
+
+    _WARM = True
+    sockname = sockname or _daemon_socket()
+    if os.path.exists(sockname):
+        os.unlink(sockname)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    oldmask = os.umask(0o077)
+    try:
+        server.bind(sockname)
+    finally:
+        os.umask(oldmask)
+    server.listen(16)
+    server.settimeout(5)
+    fdsize = struct.calcsize("i")
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            try:
+                while os.waitpid(-1, os.WNOHANG)[0]:
+                    pass
+            except OSError:
+                pass
+            try:
+                conn, addr = server.accept()
+            except socket.timeout:
+                continue
+            fds = []
+            try:
+                creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+                if struct.unpack("3i", creds)[1] != os.getuid():
+                    continue
+                msg, ancdata, flags, addr = conn.recvmsg(1, socket.CMSG_LEN(3 * fdsize))
+                for level, type, fddata in ancdata:
+                    if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+                        fds += struct.unpack("%di" % (len(fddata) // fdsize), fddata[:len(fddata) - len(fddata) % fdsize])
+                if len(fds) != 3 or msg != b"{":
+                    continue
+                sys.stdout.flush()
+                sys.stderr.flush()
+                if os.fork() == 0:
+                    server.close()
+                    signal.signal(signal.SIGINT, signal.default_int_handler)
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    status = 1
+                    try:
+                        conn.settimeout(None)
+                        status = _daemon_run(_PrefixedSocket(conn, msg), fds)
+                    finally:
+                        os._exit(status)
+            finally:
+                for fd in fds:
+                    os.close(fd)
+                conn.close()
+    finally:
+        server.close()
+        if os.path.exists(sockname):
+            os.unlink(sockname)
+
+class _PrefixedSocket(object):
+    """Socket wrapper giving back already received bytes before reading more."""
+
+    def __init__(self, sock, prefix):
+        self.sock = sock
+        self.prefix = prefix
+
+    def recv(self, size):
+        if self.prefix:
+            data, self.prefix = self.prefix, b""
+            return data
+        return self.sock.recv(size)
+
+    def sendall(self, data):
+        return self.sock.sendall(data)
+
+def client(argv=None):
+    """Forward the command (argv, cwd, environment and stdio) to a running daemon or run it directly if there is none.
+
+    This is the console entry point, so keep it light: no docopt and nothing else is parsed before we know
+    whether the daemon is there.
+    """
+    import socket
+    argv = (sys.argv if argv is None else argv)[:]
+    if "--profile-startup" in argv:
+        return main(argv) # we want to measure this process, not the daemon
+    if not hasattr(socket, "AF_UNIX") or not hasattr(socket.socket, "sendmsg"):
+        return main(argv)
+    import json
+    import array
+    import struct
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(_daemon_socket())
+        if hasattr(socket, "SO_PEERCRED"):
+            creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+            if struct.unpack("3i", creds)[1] != os.getuid():
+                raise socket.error("daemon socket is served by another user")
+    except (socket.error, OSError):
+        sock.close()
+        sock = None
+    if sock is None:
+        return main(argv) # (not from the except block, so errors of the command are not chained to this one)
+    request = json.dumps({"argv": argv, "cwd": os.getcwd(), "env": dict(os.environ)}).encode("utf-8")
+    sys.stdout.flush()
+    sys.stderr.flush()
+    sock.sendmsg([request[:1]], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [0, 1, 2]))])
+    sock.sendall(request[1:])
+    sock.shutdown(socket.SHUT_WR)
+    reply = sock.makefile("rb")
+    pid = reply.readline()
+    if not pid:
+        sock.close()
+        return main(argv) # daemon refused the request
+    while True:
+        try:
+            status = reply.readline()
+            break
+        except KeyboardInterrupt:
+            import signal
+            os.kill(int(pid), signal.SIGINT)
+    sock.close()
+    sys.exit(int(status or 1))
+
+def batch_commands(text, null=False):
+    """Split batch input into command lines: one per line (empty ones and # comments are skipped) or NUL separated."""
+    if null:
+        return [c for c in text.split("\0") if c.strip()]
+    return [c for c in (l.strip() for l in text.splitlines()) if c and not c.startswith("#")]
+
+def _batch_job(args):
+    """Run one command line through main (in a batch worker); with capture its stdout and stderr are collected."""
+    import shlex
+    line, capture = args
+    start = time.time()
+    result = {"line": line, "status": 1, "output": None}
+    if capture:
+        import tempfile
+        tmp = tempfile.TemporaryFile()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved = os.dup(1), os.dup(2)
+        os.dup2(tmp.fileno(), 1)
+        os.dup2(tmp.fileno(), 2)
+    try:
+        result["status"] = main(["cmd"] + shlex.split(line)) or 0
+    except SystemExit as e:
+        if isinstance(e.code, int) or e.code is None:
+            result["status"] = e.code or 0
+        else:
+            sys.stderr.write(str(e.code) + "\n")
+    except Exception:
+        import traceback
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if capture:
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+            tmp.seek(0)
+            result["output"] = tmp.read()
+            tmp.close()
+    result["seconds"] = time.time() - start
+    return result
+
+def batch(commands, jobs=None, ordered=True):
+    """Run many command lines (like "decomp a.zip" or "s ls -l") in one python process and a pool of workers.
+
+    It's like xargs -P built in: no interpreter startup and no usage parsing for every command.
+    jobs - number of worker processes (default: number of cpus)
+    ordered - if True, output of every command is collected and printed in the order of commands,
+              otherwise commands write directly to our stdout (so outputs can interleave)
+    Returns list of results (dicts with keys: line, status, output (None if not collected), seconds)
+    in the order of commands.
+    """
+    from multiprocessing import Pool, cpu_count
+    jobs = min(jobs or cpu_count(), len(commands))
+    out = getattr(sys.stdout, "buffer", sys.stdout)
+    if jobs <= 1:
+        return [_batch_job((c, False)) for c in commands]
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pool = Pool(jobs)
+    try:
+        results = []
+        tasks = [(c, ordered) for c in commands]
+        for result in (pool.imap if ordered else pool.imap_unordered)(_batch_job, tasks, 1):
+            if result["output"]:
+                out.write(result["output"])
+                out.flush()
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+    if not ordered:
+        index = dict((c, i) for i, c in reversed(list(enumerate(commands))))
+        results.sort(key=lambda r: index[r["line"]])
+    return results
+
+def _print_batch_summary(results, seconds):
+    failed = [r for r in results if r["status"]]
+    work = sum(r["seconds"] for r in results)
+    sys.stderr.write("%d commands, %d failed, %.2f s (%.2f s of work, %.1fx)\n" % (
+        len(results), len(failed), seconds, work, work / seconds if seconds else 0))
+    if results:
+        slowest = max(results, key=lambda r: r["seconds"])
+        sys.stderr.write("slowest: %.2f s  %s\n" % (slowest["seconds"], slowest["line"]))
+    for r in failed:
+        sys.stderr.write("failed (%s): %s\n" % (r["status"], r["line"]))
+
+def _process_age():
+    """Time (in seconds) since this process was started (including interpreter startup) or None if unknown."""
+    try:
+        with open("/proc/self/stat") as f:
+            starttime = float(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return uptime - starttime / os.sysconf("SC_CLK_TCK")
+
+_DOCOPT_GRAMMAR = {} # cache file name -> (usage text, pickled (usage, options, pattern))
 
-def main():
-    argv = sys.argv[:]
+def _parse_args(argv):
+    """Parse command line like docopt(__doc__, argv, version=VERSION, options_first=True) does.
+
+    Parsing the usage text is the expensive part, so it is done once and the resulting grammar is cached
+    (pickled, with the usage text it was made from) in memory and in the cache directory.
+    The cache file name doesn't need hashlib (its import alone costs more than the parsing we save).
+    Falls back to plain docopt if its internals are not what we expect (like in other docopt versions).
+    """
+    docopt = _docopt()
+    dm = sys.modules[docopt.__module__]
+    try:
+        DocoptExit, Option, AnyOptions, TokenStream = dm.DocoptExit, dm.Option, dm.AnyOptions, dm.TokenStream
+        parse_argv, extras = dm.parse_argv, dm.extras
+    except AttributeError:
+        return docopt(__doc__, argv=argv, version=VERSION, options_first=True)
+    import pickle
+    cachename = os.path.join(_cachedir(), "docopt-%s-%s-py%d%d" % (
+        VERSION, getattr(dm, "__version__", ""), sys.version_info[0], sys.version_info[1]))
+    doc, data = _DOCOPT_GRAMMAR.get(cachename) or _cache_load(cachename) or (None, None)
+    grammar = None
+    if doc == __doc__:
+        try:
+            grammar = pickle.loads(data)
+        except Exception:
+            grammar = None
+    if grammar is None:
+        usage = dm.printable_usage(__doc__)
+        options = dm.parse_defaults(__doc__)
+        pattern = dm.parse_pattern(dm.formal_usage(usage), options)
+        pattern_options = set(pattern.flat(Option))
+        for ao in pattern.flat(AnyOptions):
+            ao.children = list(set(dm.parse_defaults(__doc__)) - pattern_options)
+        pattern.fix()
+        data = pickle.dumps((usage, options, pattern), 2)
+        _cache_save(cachename, (__doc__, data))
+        grammar = usage, options, pattern
+    _DOCOPT_GRAMMAR[cachename] = (__doc__, data) # (unpickled again every time, because matching modifies the pattern)
+    usage, options, pattern = grammar
+    DocoptExit.usage = usage
+    argv = parse_argv(TokenStream(argv, DocoptExit), list(options), True)
+    extras(True, VERSION, argv, __doc__)
+    matched, left, collected = pattern.match(argv)
+    if matched and left == []:
+        return dm.Dict((a.name, a.value) for a in (pattern.flat() + collected))
+    raise DocoptExit()
+
+def _command(argv):
+    """Name of the built in command (not alias) selected by given command line, or None."""
+    name = argv[0] if argv else None
+    name = _ALIAS_NAMES.get(name, name)
+    return name if name in _COMMANDS else None
+
+def _recorded_imports(command):
+    """Return modules imported by the newest recorded run of given command (see main) or None if there is none.
+
+    The trace log is read in a forked child, so json (and the rest) is not loaded here before we measure it.
+    """
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        try:
+            os.close(rfd)
+            imports = None
+            for event in _trace_events():
+                if event["kind"] == "command" and event["name"] == command and "imports" in event:
+                    imports = event["imports"]
+            if imports is not None:
+                with os.fdopen(wfd, "wb") as f:
+                    f.write("\n".join(["imports"] + imports).encode("utf-8"))
+        finally:
+            os._exit(0)
+    os.close(wfd)
+    with os.fdopen(rfd, "rb") as f:
+        lines = f.read().decode("utf-8").split("\n")
+    os.waitpid(pid, 0)
+    return lines[1:] if lines[0] == "imports" else None
+
+def profile_startup(argv):
+    """Print startup time report for given command line (without running the command).
+
+    Reports time spent in: interpreter startup, loading this module, importing and running docopt
+    and importing modules the command needs. These are modules the newest run of the command (not served
+    by the daemon) really imported, as recorded in its trace event by main. Returns 1 if the total exceeds
+    STARTUP_BUDGET (or ML_CMD_STARTUP_BUDGET environment variable in milliseconds), 0 otherwise.
+
+    Example:
+    $ cmd --profile-startup e ~/.bashrc
+    """
+    age = _process_age()
+    rows = []
+    if age is not None:
+        rows.append(("interpreter", max(0.0, age - (time.time() - _STARTED))))
+    rows.append(("module ml.cmd", _LOADED - _STARTED))
+
+    start = time.time()
+    _docopt()
+    rows.append(("import docopt", time.time() - start))
+
+    start = time.time()
+    _parse_args(argv)
+    rows.append(("parse arguments", time.time() - start))
+
+    command = _command(argv) or (argv[0] if argv else None)
+    imports = _recorded_imports(command) if command else None
+    if imports is None and command:
+        print("No recorded run of %s yet, so its imports are not known (every run records them)" % command)
+    for modname in imports or []:
+        if modname in sys.modules:
+            continue # (imported by a module above, its time is there)
+        start = time.time()
+        try:
+            __import__(modname)
+        except ImportError:
+            continue # (like user modules, they are not on sys.path)
+        rows.append(("import " + modname, time.time() - start))
+
+    budget = float(os.environ.get("ML_CMD_STARTUP_BUDGET", STARTUP_BUDGET * 1000)) / 1000
+    total = sum(t for n, t in rows)
+    for name, t in rows:
+        print("%-40s %8.2f ms" % (name, t * 1000))
+    print("%-40s %8.2f ms (budget: %.2f ms)" % ("total", total * 1000, budget * 1000))
+    if "pkg_resources" in sys.modules:
+        print("warning: pkg_resources was imported (old setuptools entry point wrapper?)")
+    return 1 if total > budget else 0
+
+def main(argv=None):
+    argv = (sys.argv if argv is None else argv)[:]
 
     argv[0] = os.path.basename(argv[0])
 
     if argv[0] in ["cmd", "cmd.py"]:
         argv = argv[1:]
 
-    argdict = docopt(__doc__, argv=argv, version=VERSION, options_first=True)
-
-    if __debug__:
-         "arguments:", argdict #TODO: remove
-
-    if   argdict['run'] or argdict['r']:
-        run(argdict['<subcmd>'], *argdict['<args>'])
-    elif argdict['shell'] or argdict['s']:
-        out = shell(argdict['<subcmd>'] + ' ' + ' '.join(argdict['<args>']))
-        if out:
-            print out
-    elif argdict['term'] or argdict['t']:
-        term(*argdict['<args>'])
-    elif argdict['edit'] or argdict['e']:
-        edit(exp(argdict['<file>']))
-    elif argdict['openf'] or argdict['o']:
-        openf(exp(argdict['<file>']))
-    elif argdict['lopenf'] or argdict['lo']:
-        lopenf(exp(argdict['<file>']))
-    elif argdict['play'] or argdict['p']:
-        play(exp(argdict['<file>']))
-    elif argdict['hist'] or argdict['h']:
-        hist(*argdict['<commands>'])
-    elif argdict['decomp'] or argdict['de']:
-        decomp(exp(argdict['<file>']), exp(argdict['<dir>']))
-    elif argdict['diff'] or argdict['d']:
-        diff(exp(argdict['<file1>']), exp(argdict['<file2>']), exp(argdict['<file3>']))
-    elif argdict['fmgr'] or argdict['f']:
-        fmgr(exp(argdict['<dir>']))
-    elif argdict['fehback'] or argdict['fb']:
+    if "--profile-startup" in argv:
+        argv.remove("--profile-startup")
+        return profile_startup(argv)
+
+    command = _command(argv)
+    if command:
+        handler = _COMMANDS[command]
+        argdict = _parse_args(argv)
+    elif _is_usrcmd(argv):
+        # user functions are first class commands too (only the module defining the function is loaded)
+        command, argdict = argv[0], None
+        handler = lambda argdict: usrcmd(argv[0], *argv[1:])
+    else:
+        _parse_args(argv) # prints usage (or help, or version)
+        return
+
+    started = time.time()
+    loaded = None if _WARM else set(sys.modules)
+    status = 1
+    try:
+        status = handler(argdict)
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+        raise
+    finally:
+        fields = {"exitcode": status or 0}
+        if loaded is not None:
+            fields["imports"] = _imported_since(loaded) # (see profile_startup)
+        _trace("command", command, argv, started, **fields)
+    return status
+
+def _is_usrcmd(argv):
+    """Is the first word of argv a user function? (A broken user module is reported, but it's not a traceback.)"""
+    if not argv or argv[0].startswith("-"):
+        return False
+    try:
+        return usrcmd_get(argv[0]) is not None
+    except Exception as e:
+        sys.stderr.write("Can't load user commands: %s: %s\n" % (type(e).__name__, e))
+        return False
+
+def _shell_command(argdict):
+    if argdict['argv']:
+        import subprocess
+        stages = [[]]
+        for arg in [argdict['<subcmd>']] + argdict['<args>']:
+            if arg == "|":
+                stages.append([])
+            else:
+                stages[-1].append(arg)
+        try:
+            pipe(*stages, stdout=False)
+        except subprocess.CalledProcessError as e:
+            return e.returncode if e.returncode > 0 else 128 - e.returncode
+        return
+    out = getattr(sys.stdout, "buffer", sys.stdout)
+    for chunk in shell_iter(argdict['<subcmd>'] + ' ' + ' '.join(argdict['<args>']), lines=False, binary=True):
+        out.write(chunk)
+        out.flush()
+
+def _run_command(argdict):
+    run(argdict['<subcmd>'], *argdict['<args>'])
+
+def _term_command(argdict):
+    term(*argdict['<args>'])
+
+def _edit_command(argdict):
+    filenames = []
+    for name in argdict['<files>']:
+        if name == "-":
+            filenames.extend(sys.stdin)
+        else:
+            filenames.append(name)
+    edit_many(filenames, "tab" if argdict['tabs'] else "buffer" if argdict['buffers'] else "window")
+
+def _fehback_command(argdict):
+    if argdict['prescale']:
+        failed = fehback_prescale(exp(argdict['<dir>']))
+        if failed:
+            print("%d images couldn't be scaled" % failed)
+            return 1
+    else:
         fehback(exp(argdict['<dir>']))
-    elif argdict['usrcmd'] or argdict['uc']:
-        usrcmd(argdict['<ucmd>'], *argdict['<args>'])
 
+def _openf_command(argdict):
+    openf(exp(argdict['<file>']))
+
+def _lopenf_command(argdict):
+    lopenf(exp(argdict['<file>']))
+
+def _play_command(argdict):
+    play(*[exp(f) for f in argdict['<media>']])
+
+def _hist_command(argdict):
+    hist(*argdict['<commands>'])
+
+def _histcompact_command(argdict):
+    hist_compact(int(argdict['<limit>'] or HISTLIMIT))
+
+def _decomp_command(argdict):
+    decomp(exp(argdict['<file>']), exp(argdict['<dir>']))
+
+def _decompall_command(argdict):
+    summaries = decomp_many([exp(a) for a in argdict['<archives>']], recursive=argdict['recursive'])
+    _print_decomp_summaries(summaries)
+    if any(s["error"] for s in summaries):
+        return 1
+
+def _batch_command(argdict):
+    name = argdict['<input>']
+    if not name or name == "-":
+        text = sys.stdin.read()
+    else:
+        with _textopen(exp(name)) as f:
+            text = f.read()
+    start = time.time()
+    results = batch(batch_commands(text, argdict['null']), int(argdict['<jobs>'] or 0), not argdict['interleaved'])
+    _print_batch_summary(results, time.time() - start)
+    if any(r["status"] for r in results):
+        return 1
+
+def _arclist_command(argdict):
+    for name, size, mtype, offset, linkname in archive_index(exp(argdict['<file>'])):
+        print("%12s %-5s %s%s" % ("" if size is None else size, mtype, name, " -> " + linkname if linkname else ""))
+
+def _arcget_command(argdict):
+    print(archive_extract(exp(argdict['<file>']), argdict['<member>'], exp(argdict['<dir>'])))
+
+def _diff_command(argdict):
+    diff(exp(argdict['<file1>']), exp(argdict['<file2>']), exp(argdict['<file3>']))
+
+def _udiff_command(argdict):
+    return diff(exp(argdict['<file1>']), exp(argdict['<file2>']), exp(argdict['<file3>']), text=True)
+
+def _fmgr_command(argdict):
+    fmgr(exp(" ".join(argdict['<query>'])))
+
+def _usrcmd_command(argdict):
+    usrcmd(argdict['<ucmd>'], *argdict['<args>'])
+
+def _ps_command(argdict):
+    ps(argdict['all'])
+
+def _stats_command(argdict):
+    stats()
+
+def _daemon_command(argdict):
+    daemon()
+
+# command name -> _<name>_command function handling its parsed arguments and returning exit status (None means 0)
+# (see main; aliases are in _ALIASES)
+_COMMANDS = {
+    "run": _run_command,
+    "shell": _shell_command,
+    "term": _term_command,
+    "edit": _edit_command,
+    "openf": _openf_command,
+    "lopenf": _lopenf_command,
+    "play": _play_command,
+    "hist": _hist_command,
+    "histcompact": _histcompact_command,
+    "decomp": _decomp_command,
+    "decompall": _decompall_command,
+    "arclist": _arclist_command,
+    "arcget": _arcget_command,
+    "diff": _diff_command,
+    "udiff": _udiff_command,
+    "fmgr": _fmgr_command,
+    "fehback": _fehback_command,
+    "usrcmd": _usrcmd_command,
+    "ps": _ps_command,
+    "stats": _stats_command,
+    "batch": _batch_command,
+    "daemon": _daemon_command,
+}
+
+_ALIAS_NAMES = dict((alias, name) for name, alias in _ALIASES.items())
+
+_LOADED = time.time()
 
 if __name__ == '__main__':
-    main()
+    sys.exit(client())
 
 
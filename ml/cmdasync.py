@@ -0,0 +1,104 @@
+"""Asyncio versions of some ml.cmd commands to use from event loops (like qtile) or async REPLs (like ipython).
+
+    Needs python 3.7 or newer (unlike ml.cmd itself).
+
+    Example:
+        async for res in shell_many(["git -C %s status -s" % d for d in dirs], limit=4, timeout=10):
+            print(res.cmd, res.returncode, res.output)
+"""
+
+import asyncio
+import collections
+import functools
+import os
+import signal
+import subprocess
+
+from . import cmd as mlcmd
+
+ShellResult = collections.namedtuple("ShellResult", "cmd returncode output error")
+
+async def _kill(proc):
+    # shell commands run in their own process group, so whatever the shell started is killed too
+    # (otherwise orphans would keep our pipe open and proc.wait() would wait for them)
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    await proc.wait()
+
+async def run(cmd, *args):
+    """Run given command in new process and return the asyncio.subprocess.Process immediately (see ml.cmd.run)."""
+    return await asyncio.create_subprocess_exec(cmd, *args)
+
+async def shell(cmd, timeout=None):
+    """Run given command using system shell and return its output (see ml.cmd.shell).
+
+    timeout - seconds to wait before the command is killed and asyncio.TimeoutError is raised
+    The command is also killed when the calling task is cancelled.
+    """
+    proc = await asyncio.create_subprocess_shell(cmd, stdout=subprocess.PIPE, start_new_session=True)
+    try:
+        out, err = await asyncio.wait_for(proc.communicate(), timeout)
+    except BaseException:
+        await _kill(proc)
+        raise
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, out)
+    return out
+
+async def _in_thread(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+async def openf(filename):
+    """Open file (or url) using best available application (see ml.cmd.openf)."""
+    return await _in_thread(mlcmd.openf, filename)
+
+async def edit(filename, vimexecname="gvim", vimservername="EDITOR", addfilenames=[]):
+    """Run the best text editor (or open a file in existing instance) (see ml.cmd.edit)."""
+    return await _in_thread(mlcmd.edit, filename, vimexecname, vimservername, addfilenames)
+
+async def decomp(filename, dirname=None, progress=None):
+    """Decompresses given file (in a worker thread) (see ml.cmd.decomp).
+
+    progress - optional function called as progress(membername, membersize) in the event loop thread
+    """
+    if progress:
+        loop = asyncio.get_running_loop()
+        callback = progress
+        progress = lambda name, size: loop.call_soon_threadsafe(callback, name, size)
+    return await _in_thread(mlcmd.decomp, filename, dirname, progress)
+
+async def shell_many(cmds, limit=8, timeout=None):
+    """Run given shell commands concurrently (at most limit at once) and yield ShellResult for each as it completes.
+
+    timeout - seconds given to every single command; commands which time out are killed and reported
+              with returncode None and asyncio.TimeoutError as error
+    Failing commands don't stop the others: their returncode (and CalledProcessError) is reported.
+    When the consumer stops iterating (or is cancelled), all commands still running are killed.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def one(cmd):
+        async with semaphore:
+            proc = await asyncio.create_subprocess_shell(cmd, stdout=subprocess.PIPE, start_new_session=True)
+            try:
+                out, err = await asyncio.wait_for(proc.communicate(), timeout)
+            except asyncio.TimeoutError as e:
+                await _kill(proc)
+                return ShellResult(cmd, None, None, e)
+            except BaseException:
+                await _kill(proc)
+                raise
+            error = subprocess.CalledProcessError(proc.returncode, cmd, out) if proc.returncode else None
+            return ShellResult(cmd, proc.returncode, out, error)
+
+    tasks = [asyncio.ensure_future(one(cmd)) for cmd in cmds]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
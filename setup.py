@@ -14,36 +14,43 @@ setup(
     url = "https://github.com/langara",
     entry_points = {
         'console_scripts': [
-            'cmd = ml.cmd:main',
-            'run = ml.cmd:main',
-            'shell = ml.cmd:main',
-            'term = ml.cmd:main',
-            'edit = ml.cmd:main',
-            'openf = ml.cmd:main',
-            'lopenf = ml.cmd:main',
-            'play = ml.cmd:main',
-            'hist = ml.cmd:main',
-            'decomp = ml.cmd:main',
-            'diff = ml.cmd:main',
-            'fmgr = ml.cmd:main',
-            'fehback = ml.cmd:main',
-            'usrcmd = ml.cmd:main',
-            'r = ml.cmd:main',
-            's = ml.cmd:main',
-            't = ml.cmd:main',
-            'e = ml.cmd:main',
-            'o = ml.cmd:main',
-            'lo = ml.cmd:main',
-            'p = ml.cmd:main',
-            'h = ml.cmd:main',
-            'de = ml.cmd:main',
-            'd = ml.cmd:main',
-            'f = ml.cmd:main',
-            'fb = ml.cmd:main',
-            'uc = ml.cmd:main',
+            'cmd = ml.cmd:client',
+            'run = ml.cmd:client',
+            'shell = ml.cmd:client',
+            'term = ml.cmd:client',
+            'edit = ml.cmd:client',
+            'openf = ml.cmd:client',
+            'lopenf = ml.cmd:client',
+            'play = ml.cmd:client',
+            'hist = ml.cmd:client',
+            'decomp = ml.cmd:client',
+            'decompall = ml.cmd:client',
+            'arclist = ml.cmd:client',
+            'arcget = ml.cmd:client',
+            'diff = ml.cmd:client',
+            'udiff = ml.cmd:client',
+            'fmgr = ml.cmd:client',
+            'fehback = ml.cmd:client',
+            'usrcmd = ml.cmd:client',
+            'r = ml.cmd:client',
+            's = ml.cmd:client',
+            't = ml.cmd:client',
+            'e = ml.cmd:client',
+            'o = ml.cmd:client',
+            'lo = ml.cmd:client',
+            'p = ml.cmd:client',
+            'h = ml.cmd:client',
+            'de = ml.cmd:client',
+            'da = ml.cmd:client',
+            'al = ml.cmd:client',
+            'ag = ml.cmd:client',
+            'd = ml.cmd:client',
+            'ud = ml.cmd:client',
+            'f = ml.cmd:client',
+            'fb = ml.cmd:client',
+            'uc = ml.cmd:client',
         ]
     },
-    zip_safe = True,
-    namespace_packages = ['ml']
+    zip_safe = True
 )
 
@@ -0,0 +1,166 @@
+"""Tests of the in-process diff engine (diff_opcodes, unified_diff, diff3).
+
+    Run with: python -m unittest discover tests (or python -m pytest tests)
+    Outputs are checked against patch(1) and GNU diff3 when they are installed.
+"""
+
+import os
+import sys
+import random
+import itertools
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from ml import cmd
+
+
+def random_lines(rnd, count, alphabet):
+    return ["%s%d" % (alphabet, rnd.randint(0, 5)) for i in range(count)]
+
+def mutate(rnd, lines, unique):
+    """Return copy of lines with a few random deletions, insertions and changes (new lines are unique if unique)."""
+    lines = list(lines)
+    for k in range(rnd.randint(0, 4)):
+        i = rnd.randint(0, len(lines))
+        new = lambda: "n%d" % next(unique) if unique else "n%d" % rnd.randint(0, 3)
+        op = rnd.choice("dic")
+        if op == "d":
+            del lines[i:i + rnd.randint(1, 3)]
+        elif op == "i":
+            lines[i:i] = [new() for j in range(rnd.randint(1, 2))]
+        elif i < len(lines):
+            lines[i] = new()
+    return lines
+
+def installed(name):
+    return any(os.access(os.path.join(d, name), os.X_OK) for d in os.environ.get("PATH", "").split(os.pathsep) if d)
+
+def run(argv):
+    proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    return proc.returncode, out
+
+
+class DiffTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="ml.cmd-test-")
+        self.rnd = random.Random(1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, True)
+
+    def write(self, name, lines, newline=True):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "wb") as f:
+            f.write(("\n".join(lines) + ("\n" if newline and lines else "")).encode())
+        return path
+
+
+class DiffOpcodesTest(DiffTestCase):
+
+    def check(self, a, b):
+        opcodes = cmd.diff_opcodes(a, b)
+        i = j = 0
+        rebuilt = []
+        for tag, i1, i2, j1, j2 in opcodes:
+            self.assertEqual((i1, j1), (i, j))
+            if tag == "equal":
+                self.assertEqual(a[i1:i2], b[j1:j2])
+            else:
+                self.assertEqual(tag, "replace" if i1 < i2 and j1 < j2 else "delete" if i1 < i2 else "insert")
+            rebuilt += b[j1:j2]
+            i, j = i2, j2
+        self.assertEqual((i, j), (len(a), len(b)))
+        self.assertEqual(rebuilt, b)
+        return opcodes
+
+    def test_edge_cases(self):
+        self.assertEqual(self.check([], []), [])
+        self.assertEqual(self.check([], ["x"]), [("insert", 0, 0, 0, 1)])
+        self.assertEqual(self.check(["x"], []), [("delete", 0, 1, 0, 0)])
+        self.assertEqual(self.check(["x", "y"], ["x", "y"]), [("equal", 0, 2, 0, 2)])
+        self.assertEqual(self.check(["a", "b", "c"], ["a", "x", "c"]),
+                         [("equal", 0, 1, 0, 1), ("replace", 1, 2, 1, 2), ("equal", 2, 3, 2, 3)])
+
+    def test_random(self):
+        for n in range(300):
+            a = random_lines(self.rnd, self.rnd.randint(0, 30), "l")
+            self.check(a, mutate(self.rnd, a, None))
+            self.check(a, random_lines(self.rnd, self.rnd.randint(0, 30), "l"))
+
+    def test_minimal_for_unique_lines(self):
+        a = ["l%d" % i for i in range(50)]
+        b = a[:10] + ["new"] + a[10:30] + a[31:]
+        changed = [op for op in self.check(a, b) if op[0] != "equal"]
+        self.assertEqual(changed, [("insert", 10, 10, 10, 11), ("delete", 30, 31, 31, 31)])
+
+
+class UnifiedDiffTest(DiffTestCase):
+
+    def test_identical_files(self):
+        a = self.write("a", ["x", "y"])
+        self.assertEqual(list(cmd.unified_diff(a, a)), [])
+
+    def test_format(self):
+        a = self.write("a", ["l%d" % i for i in range(10)])
+        b = self.write("b", ["l%d" % i for i in range(10) if i != 5])
+        self.assertEqual(b"".join(cmd.unified_diff(a, b)).decode().splitlines(), [
+            "--- %s" % a, "+++ %s" % b, "@@ -3,7 +3,6 @@", " l2", " l3", " l4", "-l5", " l6", " l7", " l8"])
+
+    @unittest.skipUnless(installed("patch"), "patch is not installed")
+    def test_applies_with_patch(self):
+        out = os.path.join(self.tmpdir, "out")
+        for n in range(150):
+            lines = random_lines(self.rnd, self.rnd.randint(0, 40), "l")
+            a = self.write("a", lines, self.rnd.random() < 0.8)
+            b = self.write("b", mutate(self.rnd, lines, None), self.rnd.random() < 0.8)
+            diffname = os.path.join(self.tmpdir, "diff")
+            with open(diffname, "wb") as f:
+                f.write(b"".join(cmd.unified_diff(a, b)))
+            status, output = run(["patch", "-s", "-f", "-o", out, "-i", diffname, a])
+            self.assertEqual(status, 0, output)
+            with open(out, "rb") as f1:
+                with open(b, "rb") as f2:
+                    self.assertEqual(f1.read(), f2.read())
+
+
+class Diff3Test(DiffTestCase):
+
+    def diff3(self, mine, base, yours):
+        return b"".join(cmd.diff3(self.write("mine", mine), self.write("base", base), self.write("yours", yours))).decode()
+
+    def test_touching_changes_conflict(self):
+        base = ["l%d" % i for i in range(1, 9)]
+        mine = base[:4] + ["mine5"] + base[5:]
+        yours = base[:3] + ["yours4"] + base[4:]
+        self.assertEqual(self.diff3(mine, base, yours).splitlines(), [
+            "====", "1:4,5c", "  l4", "  mine5", "2:4,5c", "  l4", "  l5", "3:4,5c", "  yours4", "  l5"])
+
+    def test_same_change_on_both_sides(self):
+        base = ["a", "b", "c"]
+        self.assertEqual(self.diff3(["a", "x", "c"], base, ["a", "x", "c"]).splitlines(), [
+            "====2", "1:2c", "3:2c", "  x", "2:2c", "  b"])
+
+    def test_no_changes(self):
+        self.assertEqual(self.diff3(["a"], ["a"], ["a"]), "")
+
+    @unittest.skipUnless(installed("diff3"), "diff3 is not installed")
+    def test_matches_gnu_diff3(self):
+        # with unique lines both two way diffs are unambiguous, so the output has to be exactly the same
+        unique = itertools.count()
+        for n in range(300):
+            base = ["l%d" % i for i in range(self.rnd.randint(0, 15))]
+            files = [self.write(name, lines) for name, lines in
+                     (("mine", mutate(self.rnd, base, unique)), ("base", base), ("yours", mutate(self.rnd, base, unique)))]
+            status, expected = run(["diff3"] + files)
+            self.assertEqual(b"".join(cmd.diff3(*files)), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+"""Tests of in-process archive extraction (extract, archive_extract).
+
+    Run with: python -m unittest discover tests (or python -m pytest tests)
+"""
+
+import os
+import sys
+import io
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from ml import cmd
+
+
+class ExtractTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="ml.cmd-test-")
+        self.src = os.path.join(self.tmpdir, "src")
+        os.makedirs(os.path.join(self.src, "sub"))
+        for name, data in (("a.txt", b"a"), ("sub/b.txt", b"bb")):
+            with open(os.path.join(self.src, name), "wb") as f:
+                f.write(data)
+        self.stderr, sys.stderr = sys.stderr, io.StringIO() if sys.version_info[0] > 2 else io.BytesIO()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+        shutil.rmtree(self.tmpdir, True)
+
+    def path(self, *names):
+        return os.path.join(self.tmpdir, *names)
+
+    def read(self, *names):
+        with open(self.path(*names), "rb") as f:
+            return f.read()
+
+    def symlink_member(self, name, linkname):
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.SYMTYPE
+        info.linkname = linkname
+        return info
+
+
+class TarTest(ExtractTestCase):
+
+    def test_dot_root_entry(self):
+        # like "tar -C src -cf a.tar ." (members ".", "./a.txt", "./sub", ...)
+        with tarfile.open(self.path("a.tar"), "w") as tar:
+            tar.add(self.src, arcname=".")
+        self.assertEqual(cmd.extract(self.path("a.tar"), self.path("a.tar.dir")), (4, 3))
+        self.assertEqual(self.read("a.tar.dir", "a.txt"), b"a")
+        self.assertEqual(self.read("a.tar.dir", "sub", "b.txt"), b"bb")
+
+    def test_escaping_symlinks_are_skipped(self):
+        with tarfile.open(self.path("a.tar"), "w") as tar:
+            tar.addfile(self.symlink_member("abs", "/etc/passwd"))
+            tar.addfile(self.symlink_member("sub/up", "../../x"))
+            tar.addfile(self.symlink_member("sub/ok", "../a.txt"))
+            tar.add(os.path.join(self.src, "a.txt"), arcname="a.txt")
+        cmd.extract(self.path("a.tar"), self.path("out"))
+        self.assertFalse(os.path.lexists(self.path("out", "abs")))
+        self.assertFalse(os.path.lexists(self.path("out", "sub", "up")))
+        self.assertEqual(self.read("out", "sub", "ok"), b"a")
+        self.assertEqual(self.read("out", "a.txt"), b"a")
+        self.assertIn("skipping symlink", sys.stderr.getvalue())
+
+    def test_member_through_symlink_is_refused(self):
+        os.makedirs(self.path("outside"))
+        with tarfile.open(self.path("a.tar"), "w") as tar:
+            tar.addfile(self.symlink_member("link", "."))
+            info = tarfile.TarInfo("link/../../outside/f")
+            tar.addfile(info, io.BytesIO(b""))
+        self.assertRaises(ValueError, cmd.extract, self.path("a.tar"), self.path("out"))
+        self.assertEqual(os.listdir(self.path("outside")), [])
+
+
+class ZipTest(ExtractTestCase):
+
+    def test_dot_root_entry(self):
+        with zipfile.ZipFile(self.path("a.zip"), "w") as zf:
+            zf.writestr("./", b"")
+            zf.writestr("./a.txt", b"a")
+            zf.writestr("./sub/b.txt", b"bb")
+        self.assertEqual(cmd.extract(self.path("a.zip"), self.path("a.zip.dir")), (3, 3))
+        self.assertEqual(self.read("a.zip.dir", "sub", "b.txt"), b"bb")
+
+
+class ArchiveExtractTest(ExtractTestCase):
+
+    def setUp(self):
+        ExtractTestCase.setUp(self)
+        with tarfile.open(self.path("a.tar"), "w") as tar:
+            tar.add(self.src, arcname=".")
+
+    def test_one_member(self):
+        self.assertEqual(cmd.archive_extract(self.path("a.tar"), "sub/b.txt"), self.path("a.tar.dir", "sub", "b.txt"))
+        self.assertEqual(self.read("a.tar.dir", "sub", "b.txt"), b"bb")
+        self.assertEqual(os.listdir(self.path("a.tar.dir")), ["sub"])
+
+    def test_missing_member_leaves_nothing(self):
+        self.assertRaises(KeyError, cmd.archive_extract, self.path("a.tar"), "nope/nope.txt")
+        self.assertFalse(os.path.exists(self.path("a.tar.dir")))
+
+
+if __name__ == "__main__":
+    unittest.main()